@@ -1,28 +1,95 @@
-from .jupyter import is_flashcard
-
-from .jupyter import get_meta
-from .jupyter import put_meta
-
-from .jupyter import replace_double_dollars
-from .jupyter import replace_single_dollars
-from .jupyter import replace_escaped_dollars
-from .jupyter import get_attachments
-from .jupyter import replace_image_tags
-from .jupyter import process_cell
-
-from .anki import anki_invoke
-from .anki import anki_test_db
-from .anki import anki_get_decks
-from .anki import anki_find_notes
-from .anki import anki_get_note
-
-from .anki import anki_add_note
-from .anki import anki_get_note
-from .anki import anki_update_note
-from .anki import anki_delete_note
-from .anki import anki_add_or_replace_media
-from .anki import anki_get_media
-
-from .convert import read_notebooks
-from .convert import commands_prepare
-from .convert import commands_execute
+"""Jupyter <-> Anki sync library.
+
+Submodules are imported lazily on first attribute access, so that importing
+mbrain (e.g. for 'jupyanki.py --help' or Anki-only queries) does not pull in
+nbformat and nbconvert stack until something actually needs them.
+"""
+import importlib
+
+
+# Maps public name -> submodule which defines it
+_lazy_attrs = {
+    'is_flashcard': '.jupyter',
+
+    'get_meta': '.jupyter',
+    'put_meta': '.jupyter',
+
+    'replace_double_dollars': '.jupyter',
+    'replace_single_dollars': '.jupyter',
+    'replace_escaped_dollars': '.jupyter',
+    'get_attachments': '.jupyter',
+    'replace_image_tags': '.jupyter',
+    'normalize_html': '.jupyter',
+    'process_cell': '.jupyter',
+
+    'get_renderer': '.render',
+
+    'anki_invoke': '.anki',
+    'anki_multi': '.anki',
+    'anki_bind_url': '.anki',
+    'anki_connect_url': '.anki',
+    'anki_test_db': '.anki',
+    'anki_get_decks': '.anki',
+    'anki_model_id': '.anki',
+    'anki_find_notes': '.anki',
+    'anki_existing_notes': '.anki',
+    'anki_get_note': '.anki',
+    'anki_get_notes': '.anki',
+
+    'anki_add_note': '.anki',
+    'anki_can_add_notes': '.anki',
+    'anki_update_note': '.anki',
+    'anki_delete_note': '.anki',
+    'anki_add_tags': '.anki',
+    'anki_remove_tags': '.anki',
+    'anki_add_or_replace_media': '.anki',
+    'anki_get_media': '.anki',
+
+    'read_notebook_filepaths': '.convert',
+    'read_notebook': '.convert',
+    'read_notebooks': '.convert',
+    'read_note_ids': '.convert',
+    'notebook_tag': '.convert',
+    'select_changed_notebooks': '.convert',
+    'commands_prepare': '.convert',
+    'commands_prepare_pipelined': '.convert',
+    'commands_execute': '.convert',
+    'commands_stream': '.convert',
+
+    'export_apkg': '.apkg',
+
+    'outbox_default_filepath': '.outbox',
+    'outbox_queue': '.outbox',
+    'outbox_pending': '.outbox',
+    'outbox_flush': '.outbox',
+    'outbox_drop': '.outbox',
+
+    'Syncer': '.syncer',
+
+    'Endpoint': '.fanout',
+    'endpoint_meta_key': '.fanout',
+    'parse_endpoint': '.fanout',
+    'commands_prepare_fanout': '.fanout',
+    'commands_execute_fanout': '.fanout',
+
+    'git_is_repo': '.git',
+    'git_head': '.git',
+    'git_is_commit': '.git',
+    'read_last_synced': '.git',
+    'write_last_synced': '.git',
+}
+
+__all__ = list(_lazy_attrs)
+
+
+def __getattr__(name):
+    if name in _lazy_attrs:
+        module = importlib.import_module(_lazy_attrs[name], __name__)
+        value = getattr(module, name)
+        globals()[name] = value  # cache, next access won't hit __getattr__
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -1,5 +1,52 @@
+import os
 import json
-import urllib
+import threading
+import contextlib
+import urllib.request
+
+
+# Default AnkiConnect endpoint, can be overridden per thread with anki_connect_url()
+ANKI_CONNECT_URL = os.environ.get('ANKI_CONNECT_URL', 'http://localhost:8765')
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def anki_connect_url(url):
+    """Direct all anki_* calls made in this thread to given AnkiConnect endpoint.
+    
+    Example:
+        with anki_connect_url('http://staging:8765'):
+            note_ids = anki_find_notes('Notes')
+    
+    Params:
+        url (str): AnkiConnect endpoint, e.g. 'http://localhost:8765'
+    """
+    previous = getattr(_local, 'url', None)
+    _local.url = url
+    try:
+        yield
+    finally:
+        _local.url = previous
+
+
+def anki_bind_url(fn):
+    """Wrap fn to use endpoint current in calling thread, from any thread.
+    
+    anki_connect_url() applies to current thread only, so functions calling
+    Anki which are submitted to thread pools must be wrapped.
+    
+    Example:
+        with anki_connect_url('http://staging:8765'):
+            with ThreadPoolExecutor() as executor:
+                notes = executor.map(anki_bind_url(anki_get_note), note_ids)
+    """
+    url = getattr(_local, 'url', None) or ANKI_CONNECT_URL
+    
+    def wrapper(*args, **kwargs):
+        with anki_connect_url(url):
+            return fn(*args, **kwargs)
+    return wrapper
 
 
 def anki_invoke(action, **params):
@@ -17,6 +64,8 @@ def anki_invoke(action, **params):
      2. Input **2055492159** into the text box labeled Code and press the OK button to proceed.
      3. Restart Anki when prompted to do so in order to complete the installation of AnkiConnect.
     
+    Endpoint is ANKI_CONNECT_URL, unless overridden with anki_connect_url()
+    
     Params:
         action (str): method to invoke on server, e.g. 'findNotes'
         params (dict): method params, see AnkiConnect documentation
@@ -29,7 +78,7 @@ def anki_invoke(action, **params):
     def build_dict(action, **params):
         return {'action': action, 'params': params, 'version': 6}
     
-    url = 'http://localhost:8765'
+    url = getattr(_local, 'url', None) or ANKI_CONNECT_URL
     payload_dict = build_dict(action, **params)
     payload_json = json.dumps(payload_dict).encode('utf-8')
     request = urllib.request.Request(url, payload_json)
@@ -48,6 +97,34 @@ def anki_invoke(action, **params):
     return response['result']
 
 
+def anki_multi(actions):
+    """Exec many AnkiConnect actions in single request.
+    
+    Failed actions do not stop the rest, error is returned for each action.
+    
+    Params:
+        actions (list-of-tuple): (action, params) pairs,
+            e.g. [('updateNoteFields', {'note': {...}}), ...]
+    
+    Returns:
+        list-of-tuple: (result, error) for each action, error is None on success
+    """
+    if len(actions) == 0:
+        return []
+    
+    action_list = [{'action': action, 'params': params, 'version': 6}
+                   for action, params in actions]
+    res = anki_invoke('multi', actions=action_list)
+    
+    out = []
+    for r in res:
+        if isinstance(r, dict) and set(r) == {'result', 'error'}:
+            out.append((r['result'], r['error']))
+        else:
+            out.append((r, None))  # older AnkiConnect returns bare results
+    return out
+
+
 def anki_test_db():
     """Make sure 'Basic-MathJax' model exists and has fields 'Front' and 'Back'."""
     models_list = anki_invoke('modelNames')
@@ -59,6 +136,21 @@ def anki_test_db():
         raise ValueError('Model "Basic-MathJax" fields must be "Front" and "Back"')
 
         
+def anki_model_id(model_name='Basic-MathJax'):
+    """Get model (note type) ID, e.g. to export .apkg matching collection.
+    
+    Params:
+        model_name (str): model name in Anki database
+    
+    Returns:
+        int: model ID
+    """
+    models_dict = anki_invoke('modelNamesAndIds')
+    if model_name not in models_dict:
+        raise ValueError(f'Could not find "{model_name}" model in Anki database.')
+    return int(models_dict[model_name])
+
+
 def anki_get_decks():
     """Get decks in anki database.
     
@@ -68,11 +160,24 @@ def anki_get_decks():
     return anki_invoke('deckNames')
 
 
-def anki_find_notes(deck):
+def _search_escape(text):
+    """Escape text for use inside quotes in Anki search, e.g. tag:"..."
+    
+    In Anki search '_' matches any single character and '*' any sequence,
+    so 'mbrain::A_B' would also match tag 'mbrain::AxB'.
+    """
+    for char in '\\"_*':
+        text = text.replace(char, '\\' + char)
+    return text
+
+
+def anki_find_notes(deck, tag=None):
     """Get all note IDs from specified deck.
     
     Params:
         deck (str): deck name in Anki db
+        tag (str or list-of-str or None): if given, only notes with this tag
+            (or any of these tags), e.g. 'mbrain::DeepRL_Notes'
     
     Returns:
         list-of-str: note IDs from that deck
@@ -84,21 +189,84 @@ def anki_find_notes(deck):
     if deck not in decks_list:
         raise ValueError('Select dect that already exists.')
     
-    id_list = anki_invoke('findNotes', query=f'deck:"{deck}"')
+    query = f'deck:"{_search_escape(deck)}"'
+    if tag is not None:
+        tags = [tag] if isinstance(tag, str) else list(tag)
+        if len(tags) == 0:
+            return []
+        query += ' (' + ' OR '.join(f'tag:"{_search_escape(t)}"' for t in tags) + ')'
+    
+    id_list = anki_invoke('findNotes', query=query)
     return [str(id_) for id_ in id_list]
 
 
-def anki_add_note(deck, front, back):
+def anki_existing_notes(deck, note_ids):
+    """Check in single request which notes exist in specified deck.
+    
+    Params:
+        deck (str): deck name in Anki db
+        note_ids (list-of-str): note IDs to check
+    
+    Returns:
+        set-of-str: subset of note_ids which exist in that deck
+    """
+    assert isinstance(deck, str)
+    
+    if len(note_ids) == 0:
+        return set()
+    
+    query = f'deck:"{_search_escape(deck)}" nid:' + ','.join(str(id_) for id_ in note_ids)
+    id_list = anki_invoke('findNotes', query=query)
+    return {str(id_) for id_ in id_list}
+
+
+def anki_add_tags(note_ids, tag):
+    """Add tag to many notes in single request.
+    
+    Params:
+        note_ids (list-of-str): note IDs in Anki database
+        tag (str): tag to add, must not contain spaces
+    """
+    assert isinstance(tag, str) and ' ' not in tag
+    if len(note_ids) != 0:
+        anki_invoke('addTags', notes=list(note_ids), tags=tag)
+
+
+def anki_remove_tags(note_ids, tag):
+    """Remove tag from many notes in single request.
+    
+    Params:
+        note_ids (list-of-str): note IDs in Anki database
+        tag (str): tag to remove, must not contain spaces
+    """
+    assert isinstance(tag, str) and ' ' not in tag
+    if len(note_ids) != 0:
+        anki_invoke('removeTags', notes=list(note_ids), tags=tag)
+
+
+def _build_note(deck, front, back, tags=()):
+    """Build note dict as expected by AnkiConnect addNote and canAddNotes."""
+    return {
+        'deckName': deck,
+        'modelName': 'Basic-MathJax',
+        'fields': { 'Front': front, 'Back': back },
+        'options': { 'allowDuplicate': False },
+        'tags': list(tags),
+    }
+
+
+def anki_add_note(deck, front, back, tags=()):
     """Add new note to the Anki database.
     
     Front content must be unique across deck (database?)
     
-    TODO: support tags and media files
+    TODO: support media files
     
     Params:
         deck (str): name of deck to add note to, must exist
         front (str): note front side: question to display to user
         back (str): note back side: answer expected from user
+        tags (list-of-str): tags to add note with, e.g. ['mbrain::DeepRL_Notes']
     
     Returns:
         str: new note ID as string
@@ -111,19 +279,50 @@ def anki_add_note(deck, front, back):
     if deck not in decks_list:
         raise ValueError('Select dect that already exists.')
     
-    note = {
-        'deckName': deck,
-        'modelName': 'Basic-MathJax',
-        'fields': { 'Front': front, 'Back': back },
-        'options': { 'allowDuplicate': False },
-        'tags': [],
-    }
+    note = _build_note(deck, front, back, tags)
     
     id_ = anki_invoke('addNote', note=note)
     
     return str(id_)
 
 
+def anki_can_add_notes(deck, notes):
+    """Check in single request if notes could be added, without adding them.
+    
+    Uses 'canAddNotesWithErrorDetail' if AnkiConnect supports it,
+    otherwise falls back to 'canAddNotes' which gives no error reason.
+    
+    Note that Anki checks each note against database only, two notes
+    with same front in 'notes' list will both pass.
+    
+    Params:
+        deck (str): name of deck notes would be added to
+        notes (list-of-tuple): list of (front, back) pairs
+    
+    Returns:
+        list-of-str-or-None: for each note, None if note can be added,
+            otherwise error description
+    """
+    assert isinstance(deck, str)
+    assert isinstance(notes, list)
+    
+    if len(notes) == 0:
+        return []
+    
+    note_list = [_build_note(deck, front, back) for front, back in notes]
+    
+    try:
+        res = anki_invoke('canAddNotesWithErrorDetail', notes=note_list)
+        return [None if r['canAdd'] else r.get('error', 'cannot add note') for r in res]
+    except Exception as e:
+        if 'unsupported action' not in str(e):
+            raise
+    
+    # older AnkiConnect
+    res = anki_invoke('canAddNotes', notes=note_list)
+    return [None if r else 'cannot add note (empty or duplicate front?)' for r in res]
+
+
 def anki_get_note(id_):
     """Get note front and back fields.
     
@@ -151,6 +350,27 @@ def anki_get_note(id_):
     return front, back
 
 
+def anki_get_notes(note_ids):
+    """Get front and back fields of many notes in single request.
+    
+    Params:
+        note_ids (list-of-str): note IDs in Anki database
+    
+    Returns:
+        dict str->tuple: note ID -> (front, back), missing notes are skipped
+    """
+    if len(note_ids) == 0:
+        return {}
+    
+    notes = {}
+    for info in anki_invoke('notesInfo', notes=list(note_ids)):
+        if info.get('noteId') is None:
+            continue  # no such note
+        fields = info['fields']
+        notes[str(info['noteId'])] = (fields['Front']['value'], fields['Back']['value'])
+    return notes
+
+
 def anki_update_note(id_, front, back):
     """Update existing note. Note must exist.
     
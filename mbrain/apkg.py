@@ -0,0 +1,334 @@
+"""Offline export of flashcards into Anki package (.apkg) file.
+
+Package is a zip archive with:
+ - 'collection.anki2': SQLite Anki collection (schema version 11)
+ - 'media': JSON mapping zip entry name -> media filename, e.g. {"0": "9ea0..."}
+ - '0', '1', ...: media files content
+
+Notes are written with same IDs as in notebooks <!--- ---> meta (new IDs
+are generated and written back to notebooks), and same media filenames
+(attachment SHA256) as sync via AnkiConnect uses, so after importing
+package into Anki, incremental 'jupyanki.py sync' will match imported notes.
+
+Notes use target collection's own 'Basic-MathJax' model ID (see
+anki_model_id()), otherwise Anki would import them under new 'Basic-MathJax+'
+model, which sync does not recognize. Model in package has modification
+time 0, so Anki keeps user's templates and styling on import.
+
+Note: if target collection already has note with same ID but different
+content (not imported from this tool), Anki will assign a new ID on import.
+"""
+
+import os
+import re
+import json
+import time
+import base64
+import sqlite3
+import hashlib
+import zipfile
+import tempfile
+
+from .jupyter import put_meta
+from .jupyter import is_flashcard
+from .jupyter import process_cell
+
+
+_schema = '''
+CREATE TABLE col (
+    id integer primary key, crt integer not null, mod integer not null,
+    scm integer not null, ver integer not null, dty integer not null,
+    usn integer not null, ls integer not null, conf text not null,
+    models text not null, decks text not null, dconf text not null,
+    tags text not null
+);
+CREATE TABLE notes (
+    id integer primary key, guid text not null, mid integer not null,
+    mod integer not null, usn integer not null, tags text not null,
+    flds text not null, sfld integer not null, csum integer not null,
+    flags integer not null, data text not null
+);
+CREATE TABLE cards (
+    id integer primary key, nid integer not null, did integer not null,
+    ord integer not null, mod integer not null, usn integer not null,
+    type integer not null, queue integer not null, due integer not null,
+    ivl integer not null, factor integer not null, reps integer not null,
+    lapses integer not null, left integer not null, odue integer not null,
+    odid integer not null, flags integer not null, data text not null
+);
+CREATE TABLE revlog (
+    id integer primary key, cid integer not null, usn integer not null,
+    ease integer not null, ivl integer not null, lastIvl integer not null,
+    factor integer not null, time integer not null, type integer not null
+);
+CREATE TABLE graves (
+    usn integer not null, oid integer not null, type integer not null
+);
+CREATE INDEX ix_notes_usn on notes (usn);
+CREATE INDEX ix_cards_usn on cards (usn);
+CREATE INDEX ix_revlog_usn on revlog (usn);
+CREATE INDEX ix_cards_nid on cards (nid);
+CREATE INDEX ix_cards_sched on cards (did, queue, due);
+CREATE INDEX ix_revlog_cid on revlog (cid);
+CREATE INDEX ix_notes_csum on notes (csum);
+'''
+
+# Same script as README.md asks to paste into Basic-MathJax templates
+_mathjax_script = '''
+<script type="text/x-mathjax-config">
+    MathJax.Hub.processSectionDelay = 0;
+    MathJax.Hub.Config({
+        messageStyle:"none",
+        showProcessingMessages:false,
+        tex2jax:{
+            inlineMath: [ ['$','$'], ['\\\\(','\\\\)'] ],
+            displayMath: [ ['$$','$$'], ['\\\\[','\\\\]'] ],
+            processEscapes:true
+        }
+});
+</script>
+<script type="text/javascript">
+(function() {
+  if (window.MathJax != null) {
+    var card = document.querySelector('.card');
+    MathJax.Hub.Queue(['Typeset', MathJax.Hub, card]);
+    return;
+  }
+  var script = document.createElement('script');
+  script.type = 'text/javascript';
+  script.src = 'https://cdnjs.cloudflare.com/ajax/libs/mathjax/2.7.1/MathJax.js?config=TeX-AMS_SVG-full';
+  document.body.appendChild(script);
+})();
+</script>
+'''
+
+_css = '''.card {
+ font-family: arial;
+ font-size: 20px;
+ text-align: center;
+ color: black;
+ background-color: white;
+}
+'''
+
+
+def _stable_id(string):
+    """Deterministic 13-digit ID derived from string, so re-exports match."""
+    digest = hashlib.sha256(string.encode()).hexdigest()
+    return 1000000000000 + int(digest[:12], 16) % 1000000000000
+
+
+def _guid(note_id):
+    """Note GUID, stable for given note ID."""
+    return hashlib.sha256(f'mbrain:{note_id}'.encode()).hexdigest()[:10]
+
+
+def _checksum(field):
+    """Anki first field checksum: first 8 hex digits of SHA1, as int."""
+    return int(hashlib.sha1(field.encode()).hexdigest()[:8], 16)
+
+
+def _sort_field(field):
+    """Anki sort field: field without html tags."""
+    return re.sub(r'<[^>]+>', '', field)
+
+
+def _model(model_id, deck_id):
+    """Basic-MathJax model definition, fields 'Front' and 'Back'.
+
+    Modification time is 0, so existing model with same ID is never
+    overwritten on import.
+    """
+    def fld(name, ord_):
+        return {'name': name, 'ord': ord_, 'sticky': False, 'rtl': False,
+                'font': 'Arial', 'size': 20, 'media': []}
+    return {
+        'id': model_id,
+        'name': 'Basic-MathJax',
+        'type': 0,
+        'mod': 0,
+        'usn': -1,
+        'sortf': 0,
+        'did': deck_id,
+        'tmpls': [{
+            'name': 'Card 1',
+            'ord': 0,
+            'qfmt': '{{Front}}' + _mathjax_script,
+            'afmt': '{{FrontSide}}\n\n<hr id=answer>\n\n{{Back}}' + _mathjax_script,
+            'did': None,
+            'bqfmt': '',
+            'bafmt': '',
+        }],
+        'flds': [fld('Front', 0), fld('Back', 1)],
+        'css': _css,
+        'latexPre': ('\\documentclass[12pt]{article}\n\\special{papersize=3in,5in}\n'
+                     '\\usepackage[utf8]{inputenc}\n\\usepackage{amssymb,amsmath}\n'
+                     '\\pagestyle{empty}\n\\setlength{\\parindent}{0in}\n\\begin{document}\n'),
+        'latexPost': '\\end{document}',
+        'tags': [],
+        'vers': [],
+        'req': [[0, 'any', [0]]],
+    }
+
+
+def _deck(deck_id, name, now):
+    return {
+        'id': deck_id,
+        'name': name,
+        'mod': now,
+        'usn': -1,
+        'lrnToday': [0, 0],
+        'revToday': [0, 0],
+        'newToday': [0, 0],
+        'timeToday': [0, 0],
+        'collapsed': False,
+        'desc': '',
+        'dyn': 0,
+        'conf': 1,
+        'extendNew': 10,
+        'extendRev': 50,
+    }
+
+
+_dconf = {
+    '1': {
+        'id': 1, 'name': 'Default', 'mod': 0, 'usn': 0, 'maxTaken': 60,
+        'autoplay': True, 'timer': 0, 'replayq': True, 'dyn': False,
+        'new': {'delays': [1, 10], 'ints': [1, 4, 7], 'initialFactor': 2500,
+                'order': 1, 'perDay': 20, 'bury': True, 'separate': True},
+        'lapse': {'delays': [10], 'mult': 0, 'minInt': 1,
+                  'leechFails': 8, 'leechAction': 0},
+        'rev': {'perDay': 100, 'ease4': 1.3, 'fuzz': 0.05, 'minSpace': 1,
+                'ivlFct': 1, 'maxIvl': 36500, 'bury': True},
+    }
+}
+
+
+def _write_collection(db_filepath, anki_deck_name, model_id, notes):
+    """Create SQLite Anki collection with notes.
+
+    Params:
+        db_filepath (str): where to create collection file
+        anki_deck_name (str): deck to put notes into
+        model_id (int): 'Basic-MathJax' model ID in target collection
+        notes (list-of-tuple): (note_id, front, back, tag) tuples
+    """
+    now = int(time.time())
+    deck_id = _stable_id('deck:' + anki_deck_name)
+
+    conf = {
+        'nextPos': len(notes) + 1, 'estTimes': True, 'activeDecks': [1],
+        'sortType': 'noteFld', 'timeLim': 0, 'sortBackwards': False,
+        'addToCur': True, 'curDeck': 1, 'newBury': True, 'newSpread': 0,
+        'dueCounts': True, 'curModel': str(model_id), 'collapseTime': 1200,
+    }
+    models = {str(model_id): _model(model_id, deck_id)}
+    decks = {
+        '1': _deck(1, 'Default', now),
+        str(deck_id): _deck(deck_id, anki_deck_name, now),
+    }
+
+    conn = sqlite3.connect(db_filepath)
+    try:
+        conn.executescript(_schema)
+        conn.execute('INSERT INTO col VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                     (1, now, now * 1000, now * 1000, 11, 0, 0, 0,
+                      json.dumps(conf), json.dumps(models), json.dumps(decks),
+                      json.dumps(_dconf), json.dumps({})))
+
+        note_rows = []
+        card_rows = []
+        for due, (note_id, front, back, tag) in enumerate(notes, start=1):
+            nid = int(note_id)
+            note_rows.append((nid, _guid(note_id), model_id, now, -1, ' ' + tag + ' ',
+                              front + '\x1f' + back, _sort_field(front),
+                              _checksum(_sort_field(front)), 0, ''))
+            card_rows.append((nid, nid, deck_id, 0, now, -1,
+                              0, 0, due, 0, 0, 0, 0, 0, 0, 0, 0, ''))
+
+        conn.executemany('INSERT INTO notes VALUES (?,?,?,?,?,?,?,?,?,?,?)', note_rows)
+        conn.executemany('INSERT INTO cards VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)', card_rows)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def export_apkg(file_nb_dict, anki_deck_name, apkg_filepath, model_id, dbg_print=False,
+                renderer=None):
+    """Export all flashcards from notebooks into Anki package file.
+
+    Cells without note ID in <!--- ---> meta get new ID, which is written
+    into cell source with put_meta(). Changed notebooks are written back to
+    disk after package file is written successfully.
+
+    Params:
+        file_nb_dict (dict str->nbformat.notebooknode.NotebookNode):
+            dict mapping .ipynb file paths to notebook objects
+        anki_deck_name (str): deck name in package, created on import if missing
+        apkg_filepath (str): output .apkg file path
+        model_id (int): 'Basic-MathJax' model ID in collection package will be
+            imported into, see anki_model_id()
+        dbg_print (bool): if True, print debug info
+        renderer (str or None): markdown renderer backend, see process_cell()
+
+    Returns:
+        list-of-mbrain.Command: one 'add' command per exported flashcard
+    """
+    from .convert import Command  # avoid import cycle
+    from .convert import _write_notebooks
+
+    assert isinstance(file_nb_dict, dict)
+    assert isinstance(anki_deck_name, str)
+    assert isinstance(apkg_filepath, str)
+    assert isinstance(model_id, int)
+
+    commands = []
+    used_ids = set()
+    next_id = int(time.time() * 1000)
+
+    for filename, nb in file_nb_dict.items():
+        if dbg_print: print('Processing:', filename)
+        for cell in nb['cells']:
+            if not is_flashcard(cell):
+                continue
+
+            meta, head, body, attachments = process_cell(cell, dbg_print, renderer)
+
+            id_ = meta.get('id')
+            if id_ is None or id_ in used_ids:
+                while str(next_id) in used_ids:
+                    next_id += 1
+                id_ = str(next_id)
+                next_id += 1
+            used_ids.add(id_)
+
+            cmd = Command('add', id_, head, body, deck=anki_deck_name,
+                          filepath=filename, cell=cell, attachments=attachments)
+            new_source = put_meta(cell.source, id_)
+            if cell.source != new_source:
+                cell.source = new_source
+                cmd.notebook_changed = True
+            commands.append(cmd)
+
+    # Media keyed by attachment SHA256, same as AnkiConnect sync stores them
+    media = {}
+    for cmd in commands:
+        for name, (key, value) in cmd.attachments.items():
+            media[key] = value
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_filepath = os.path.join(tmp_dir, 'collection.anki2')
+        _write_collection(db_filepath, anki_deck_name, model_id,
+                          [(cmd.id, cmd.head, cmd.body, cmd.tag) for cmd in commands])
+
+        with zipfile.ZipFile(apkg_filepath, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.write(db_filepath, 'collection.anki2')
+            media_map = {}
+            for i, (key, value) in enumerate(sorted(media.items())):
+                zf.writestr(str(i), base64.b64decode(value))
+                media_map[str(i)] = key
+            zf.writestr('media', json.dumps(media_map))
+
+    _write_notebooks(file_nb_dict, commands)
+
+    return commands
@@ -1,18 +1,28 @@
 import os
+import re
 import glob
+import json
+import threading
+import concurrent.futures
 
-import nbformat
-
+from .jupyter import get_meta
 from .jupyter import put_meta
 
 from .anki import anki_get_note
 from .anki import anki_add_note
+from .anki import anki_can_add_notes
 from .anki import anki_update_note
 from .anki import anki_get_media
 from .anki import anki_add_or_replace_media
 from .anki import anki_find_notes
+from .anki import anki_bind_url
+from .anki import anki_existing_notes
+from .anki import anki_add_tags
+from .anki import anki_remove_tags
 from .jupyter import is_flashcard
 from .jupyter import process_cell
+from .jupyter import normalize_html
+from .git import git_changed_files
 
 class Command:
     """Thin wrapper around command parameters.
@@ -28,9 +38,12 @@ class Command:
         notebook_filepath (str): path to notebook filename containing cell node
         notebook_changed (bool): True means cell metadata changed and .ipynb file needs update
         notebook_may_change (bool): True means command can may requrie update to .ipynb file
+        error (str): if not None, pre-flight validation says command will fail
+        meta_key (str): key in cell <!--- ---> meta to store new note ID under
+        tag (str): notebook tag to stamp note with, see notebook_tag()
     """
     def __init__(self, cmd, id_, head, body, deck=None,
-                 filepath=None, notebook=None, cell=None, attachments=None):
+                 filepath=None, notebook=None, cell=None, attachments=None, meta_key='id'):
         assert isinstance(cmd, str)
         assert cmd in {'noop', 'add', 'add2', 'update'}
         
@@ -42,8 +55,11 @@ class Command:
         self.cell = cell
         self.attachments = attachments
         
-        self.notebook_filepath = None
+        self.notebook_filepath = filepath
         self.notebook_changed = False
+        self.error = None
+        self.meta_key = meta_key
+        self.tag = notebook_tag(filepath) if filepath is not None else None
         
         if cmd in {'add', 'add2'}:
             self.notebook_may_change = True
@@ -51,15 +67,14 @@ class Command:
             self.notebook_may_change = False
 
         
-def read_notebooks(notes_folder_location):
-    """Read .ipynb files from specified location.
+def read_notebook_filepaths(notes_folder_location):
+    """Read list of .ipynb files to sync from 'anki_sync.txt' in notes folder.
     
     Params:
         notes_folder_location (str): folder with .ipynb notes
     
     Returns:
-        dict str->nbformat.notebooknode.NotebookNode:
-            dict mapping .ipynb file paths to notebook objects
+        list-of-str: .ipynb file paths, e.g. ['/../notes/DeepRL_Notes.ipynb']
     """
     
     # Find all .ipynb files in notes_folder
@@ -76,56 +91,161 @@ def read_notebooks(notes_folder_location):
             if len(fp) != 0 and not fp.startswith('#'):
                 notebook_filepaths.append(os.path.join(notes_folder_location, fp))
     
+    return notebook_filepaths
+
+
+def read_notebook(file_location):
+    """Read single .ipynb file.
+    
+    Params:
+        file_location (str): path to .ipynb file
+    
+    Returns:
+        nbformat.notebooknode.NotebookNode: notebook object
+    """
+    import nbformat  # deferred, heavy import
+    
+    with open(file_location, 'r') as f:
+        return nbformat.read(f, as_version=4)
+
+
+def read_notebooks(notes_folder_location):
+    """Read .ipynb files from specified location.
+    
+    Params:
+        notes_folder_location (str): folder with .ipynb notes
+    
+    Returns:
+        dict str->nbformat.notebooknode.NotebookNode:
+            dict mapping .ipynb file paths to notebook objects
+    """
     file_nb_dict = {}
     
-    for file_location in notebook_filepaths:
-        with open(file_location, 'r') as f:
-            nb = nbformat.read(f, as_version=4)
-            file_nb_dict[file_location] = nb
+    for file_location in read_notebook_filepaths(notes_folder_location):
+        file_nb_dict[file_location] = read_notebook(file_location)
             
     return file_nb_dict
 
         
-def _figure_out_command(meta, head, body, note_ids):
+def read_note_ids(file_location):
+    """Read note IDs from flashcards meta only, without rendering cards.
+    
+    This is much cheaper than read_notebook() + process_cell(), used to
+    find which Anki notes are still referenced by notebooks not being synced.
+    
+    Params:
+        file_location (str): path to .ipynb file
+    
+    Returns:
+        set-of-str: note IDs, e.g. {'1560133178581', '1560133182006'}
+    """
+    with open(file_location, 'r') as f:
+        nb_dict = json.load(f)
+    
+    note_ids = set()
+    for cell in nb_dict['cells']:
+        if not is_flashcard(cell):
+            continue
+        source = cell['source']
+        if isinstance(source, list):
+            source = ''.join(source)
+        meta = get_meta(source)
+        if 'id' in meta:
+            note_ids.add(meta['id'])
+    return note_ids
+
+
+def notebook_tag(notebook_filepath):
+    """Anki tag identifying notes which come from given notebook.
+    
+    Tag is derived from notebook file name, so notebooks listed in
+    anki_sync.txt must have unique names.
+    
+    Params:
+        notebook_filepath (str): e.g. '/../notes/DeepRL_Notes.ipynb'
+    
+    Returns:
+        str: tag, e.g. 'mbrain::DeepRL_Notes'
+    """
+    name = os.path.splitext(os.path.basename(notebook_filepath))[0]
+    return 'mbrain::' + re.sub(r'\s+', '_', name)
+
+
+def select_changed_notebooks(notes_folder_location, notebook_filepaths, since):
+    """Split notebooks into ones changed since git revision and the rest.
+    
+    If 'anki_sync.txt' itself changed, all notebooks are considered changed,
+    as newly listed notebooks may not have changed in git.
+    
+    Params:
+        notes_folder_location (str): folder with .ipynb notes, inside git repo
+        notebook_filepaths (list-of-str): as from read_notebook_filepaths()
+        since (str): git revision, e.g. last synced commit hash
+    
+    Returns:
+        changed (list-of-str): notebooks to sync
+        unchanged (list-of-str): notebooks to skip
+    """
+    changed_files = git_changed_files(notes_folder_location, since)
+    
+    if 'anki_sync.txt' in changed_files:
+        return list(notebook_filepaths), []
+    
+    changed, unchanged = [], []
+    for filepath in notebook_filepaths:
+        relpath = os.path.normpath(os.path.relpath(filepath, notes_folder_location))
+        if relpath in changed_files:
+            changed.append(filepath)
+        else:
+            unchanged.append(filepath)
+    return changed, unchanged
+
+        
+def _figure_out_command(meta, head, body, note_ids, get_note=anki_get_note, **card):
     """Based on available information, estabilish which command to run.
     
     Commands possible are:
      - if 'meta' has no 'id', then execude ADD command
      - if 'meta' has 'id', but 'id' is not in Anki, then execute ADD2
      - if 'meta' has valid 'id', then pull card from Anki and if
-       there is a difference, then execute UPDATE
+       there is a difference (after normalize_html()), then execute UPDATE
        
     Params:
         meta (str), head (str), body (str): as returned from process_cell() function
         note_ids (list-of-str): list of note IDs in Anki deck
+        get_note (callable): note ID -> (front, back), e.g. cached anki_get_note
+        card: passed to Command(), e.g. deck, cell, attachments, filepath
         
     Returns:
         Command: object describing action to perform on Anki DB
     """
     if 'id' not in meta:
         # This note has empty <!------>, meaning it was just added in Jupyter
-        cmd = Command('add', None, head, body)
+        cmd = Command('add', None, head, body, **card)
     else:
         # Get note Anki ID
         id_ = meta['id']
 
         if id_ not in note_ids:
             # card was probably manually deleted from Anki, recreate it
-            cmd = Command('add2', None, head, body)
+            cmd = Command('add2', None, head, body, **card)
         else:
             # ID exists in database
 
-            front, back = anki_get_note(id_)
-            if front != head or back != body:
-                cmd = Command('update', id_, head, body)
+            front, back = get_note(id_)
+            # Anki rewrites stored html, compare canonical forms only
+            if normalize_html(front) != normalize_html(head) \
+                    or normalize_html(back) != normalize_html(body):
+                cmd = Command('update', id_, head, body, **card)
             else:
-                cmd = Command('noop', id_, head, body)
+                cmd = Command('noop', id_, head, body, **card)
     return cmd
 
 
 
 
-def commands_prepare(file_nb_dict, anki_deck_name, dbg_print=False):
+def commands_prepare(file_nb_dict, anki_deck_name, dbg_print=False, renderer=None,
+                     validate=False):
     """Query Anki DB and check notes folder and prepare commands to sync.
     
     This function does not alter Anki database or notes folder.
@@ -135,6 +255,9 @@ def commands_prepare(file_nb_dict, anki_deck_name, dbg_print=False):
             dict mapping .ipynb file paths to notebook objects
         anki_deck_name (str): deck name in Anki database to sync to
         dbg_print (bool): if True, print debug info
+        renderer (str or None): markdown renderer backend, see process_cell()
+        validate (bool): if True, check all 'add' and 'add2' commands with Anki
+            in single request and set Command.error on ones that would fail
         
     Returns:
         list-of-mbrain.Command: list of commands, which if executed, will do sync
@@ -148,30 +271,209 @@ def commands_prepare(file_nb_dict, anki_deck_name, dbg_print=False):
     # print(existing_note_ids)
     # ['1560133178581', '1560133182006', ... ]
     assert len(existing_note_ids) == len(set(existing_note_ids))
+    existing_note_ids = set(existing_note_ids)
 
     commands = []
 
     for filename, nb in file_nb_dict.items():
-        if dbg_print: print('Processing:', filename)
-        for cell in nb['cells']:
-            if not is_flashcard(cell):
-                continue
-
-            meta, head, body, attachments = process_cell(cell, dbg_print)
-            cmd = _figure_out_command(meta, head, body, existing_note_ids)
-            if cmd is not None:
-                cmd.deck = anki_deck_name
-                cmd.cell = cell
-                cmd.attachments = attachments
-                cmd.notebook_filepath = filename
-                commands.append(cmd)
+        commands.extend(_prepare_notebook(filename, nb, anki_deck_name, existing_note_ids,
+                                          dbg_print, renderer))
+    
+    orphaned_ids = _find_orphaned_ids(existing_note_ids, commands)
+    
+    if validate:
+        _validate_commands(commands)
+                
+    return commands, orphaned_ids
+
+
+def commands_prepare_pipelined(notebook_filepaths, anki_deck_name, dbg_print=False,
+                               renderer=None, validate=False, num_workers=8,
+                               other_note_ids=None, scope_by_tag=False):
+    """Same as read_notebooks() + commands_prepare(), but overlaps CPU and network.
+    
+    Pipeline is as follows:
+     - deck snapshot (anki_find_notes) is fetched in background thread,
+       while notebooks are being read
+     - main thread reads notebooks and renders cards with process_cell(),
+       each rendered card is queued to thread pool
+     - pool workers query Anki for that card (anki_get_note) and diff it
+    
+    So rendering of next cards happens while previous cards wait for Anki.
+    Commands are returned in same order as from commands_prepare().
+    
+    With scope_by_tag, instead of whole deck only notes tagged with synced
+    notebooks tags (see notebook_tag()) are fetched and checked for orphans.
+    Cards whose note is not tagged yet (e.g. cell moved from other notebook,
+    or synced before tags were introduced) are checked with Anki in single
+    request, restricted to the deck. Notebooks are read before the snapshot
+    request in this mode, as their note IDs are part of it.
+    
+    This function does not alter Anki database or notes folder.
+    
+    Params:
+        notebook_filepaths (list-of-str): .ipynb files to sync,
+            see read_notebook_filepaths()
+        anki_deck_name (str): deck name in Anki database to sync to
+        dbg_print (bool): if True, print debug info
+        renderer (str or None): markdown renderer backend, see process_cell()
+        validate (bool): if True, pre-flight check new cards, see commands_prepare()
+        num_workers (int): number of threads querying Anki
+        other_note_ids (set-of-str or None): note IDs used by notebooks which
+            are not being synced (see read_note_ids()), never reported as orphaned
+        scope_by_tag (bool): if True, query Anki only for notes tagged with
+            synced notebooks, useful if syncing few notebooks of large deck
+    
+    Returns:
+        file_nb_dict (dict str->nbformat.notebooknode.NotebookNode):
+            dict mapping .ipynb file paths to notebook objects
+        commands (list-of-mbrain.Command): see commands_prepare()
+        orphaned_ids (set-of-str): see commands_prepare()
+    """
+    assert isinstance(notebook_filepaths, list)
+    assert isinstance(anki_deck_name, str)
+    assert isinstance(dbg_print, bool)
+    assert num_workers >= 1
+    
+    def fetch_note_ids():
+        note_ids = anki_find_notes(anki_deck_name)
+        assert len(note_ids) == len(set(note_ids))
+        note_ids = set(note_ids)
+        return note_ids, note_ids
+    
+    def fetch_tagged_note_ids(card_ids):
+        tags = [notebook_tag(fp) for fp in notebook_filepaths]
+        tagged_ids = set(anki_find_notes(anki_deck_name, tags))
+        # not tagged yet, e.g. moved from other notebook or synced before tags
+        existing_ids = anki_existing_notes(anki_deck_name, sorted(card_ids - tagged_ids))
+        return tagged_ids, tagged_ids | existing_ids
+    
+    def lookup(filename, cell, meta, head, body, attachments):
+        # Runs in worker thread, blocks until deck snapshot arrives
+        _, note_ids = note_ids_future.result()
+        return _figure_out_command(meta, head, body, note_ids, deck=anki_deck_name,
+                                   cell=cell, attachments=attachments, filepath=filename)
+    
+    file_nb_dict = {}
+    futures = []
     
+    # +1 thread so deck snapshot does not wait behind lookups
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers + 1) as executor:
+        if scope_by_tag:
+            card_ids = set()
+            for filename in notebook_filepaths:
+                file_nb_dict[filename] = read_notebook(filename)
+                for cell in file_nb_dict[filename]['cells']:
+                    if is_flashcard(cell) and 'id' in get_meta(cell.source):
+                        card_ids.add(get_meta(cell.source)['id'])
+            note_ids_future = executor.submit(anki_bind_url(fetch_tagged_note_ids), card_ids)
+        else:
+            note_ids_future = executor.submit(anki_bind_url(fetch_note_ids))
+        
+        for filename in notebook_filepaths:
+            if filename not in file_nb_dict:
+                file_nb_dict[filename] = read_notebook(filename)
+            nb = file_nb_dict[filename]
+            
+            if dbg_print: print('Processing:', filename)
+            for cell in nb['cells']:
+                if not is_flashcard(cell):
+                    continue
+                
+                meta, head, body, attachments = process_cell(cell, dbg_print, renderer)
+                futures.append(executor.submit(anki_bind_url(lookup), filename, cell,
+                                               meta, head, body, attachments))
+        
+        commands = [f.result() for f in futures]
+        existing_note_ids, _ = note_ids_future.result()
+    
+    # in scoped mode, note may be tagged with one notebook but used by other
+    used_ids = {cmd.id for cmd in commands if cmd.id is not None}
+    orphaned_ids = existing_note_ids - used_ids
+    if other_note_ids is not None:
+        orphaned_ids -= set(other_note_ids)
+    
+    if validate:
+        _validate_commands(commands)
+    
+    return file_nb_dict, commands, orphaned_ids
+
+
+def _find_orphaned_ids(existing_note_ids, commands):
+    """Note IDs in Anki deck, which are not referenced by any command."""
     orphaned_ids = set(existing_note_ids)
     for cmd in commands:
         if cmd.id is not None:   # add, add2
             orphaned_ids.remove(cmd.id)
-                
-    return commands, orphaned_ids
+    return orphaned_ids
+
+
+def _validate_commands(commands):
+    """Pre-flight check of 'add' and 'add2' commands, sets Command.error.
+    
+    All notes are checked with single canAddNotes request, so bad run can be
+    rejected before anything is written to Anki. Fronts repeated within
+    commands are also rejected, as Anki would only fail on second addNote.
+    
+    Params:
+        commands (list-of-mbrain.Command): commands as from commands_prepare()
+    
+    Returns:
+        list-of-mbrain.Command: commands which failed validation
+    """
+    add_commands = [cmd for cmd in commands if cmd.cmd in {'add', 'add2'}]
+    
+    by_deck = {}
+    for cmd in add_commands:
+        by_deck.setdefault(cmd.deck, []).append(cmd)
+    
+    for deck, deck_commands in by_deck.items():
+        errors = anki_can_add_notes(deck, [(cmd.head, cmd.body) for cmd in deck_commands])
+        for cmd, error in zip(deck_commands, errors):
+            cmd.error = error
+    
+    fronts_seen = set()
+    for cmd in add_commands:
+        if cmd.error is None and cmd.head in fronts_seen:
+            cmd.error = 'duplicate front within notebooks'
+        fronts_seen.add(cmd.head)
+    
+    return [cmd for cmd in commands if cmd.error is not None]
+
+
+def _prepare_notebook(filename, nb, anki_deck_name, existing_note_ids,
+                      dbg_print=False, renderer=None):
+    """Prepare commands to sync single notebook, see commands_prepare()
+    
+    Params:
+        filename (str): path to .ipynb file
+        nb (nbformat.notebooknode.NotebookNode): notebook object
+        anki_deck_name (str): deck name in Anki database to sync to
+        existing_note_ids (set-of-str): note IDs in Anki deck
+        dbg_print (bool): if True, print debug info
+        renderer (str or None): markdown renderer backend, see process_cell()
+    
+    Returns:
+        list-of-mbrain.Command: commands for flashcards in this notebook
+    """
+    commands = []
+    
+    if dbg_print: print('Processing:', filename)
+    for cell in nb['cells']:
+        if not is_flashcard(cell):
+            continue
+
+        meta, head, body, attachments = process_cell(cell, dbg_print, renderer)
+        cmd = _figure_out_command(meta, head, body, existing_note_ids, deck=anki_deck_name,
+                                  cell=cell, attachments=attachments, filepath=filename)
+        commands.append(cmd)
+    
+    return commands
+
+
+# Guards cell.source updates, commands for same cell may run in parallel
+# when syncing to multiple Anki collections, see mbrain.fanout
+_cell_lock = threading.Lock()
 
 
 def _exec_command(cmd):
@@ -184,12 +486,14 @@ def _exec_command(cmd):
     assert cmd.cell is not None
     assert cmd.attachments is not None
     if cmd.cmd in ['add', 'add2']:
-        id_ = anki_add_note(cmd.deck, cmd.head, cmd.body)
-        new_meta = put_meta(cmd.cell.source, id_)
-        if cmd.cell.source != new_meta:
-            # need to update jupyter notebook
-            cmd.cell.source = new_meta
-            cmd.notebook_changed = True
+        tags = [cmd.tag] if cmd.tag is not None else []
+        id_ = anki_add_note(cmd.deck, cmd.head, cmd.body, tags)
+        with _cell_lock:
+            new_meta = put_meta(cmd.cell.source, id_, cmd.meta_key)
+            if cmd.cell.source != new_meta:
+                # need to update jupyter notebook
+                cmd.cell.source = new_meta
+                cmd.notebook_changed = True
         for name, (key, value) in cmd.attachments.items():
             if anki_get_media(key) is None:
                 anki_add_or_replace_media(key, value)
@@ -199,17 +503,59 @@ def _exec_command(cmd):
         pass # do nothing
     else:
         raise ValueError(f'Unknown command: {cmd.cmd}')
-        
+
+
+def _update_tags(commands):
+    """Make notebook tags in Anki match executed commands, see notebook_tag()
+    
+    For each notebook tag, adds it to notes which lack it and removes it from
+    notes now referenced by a different notebook (cell moved), using one
+    addTags/removeTags request per tag. Orphaned notes keep their tag, so
+    scoped sync still reports them until pruned. Must be called after
+    commands were executed.
+    
+    Params:
+        commands (list-of-mbrain.Command): executed commands
+    """
+    by_tag = {}
+    for cmd in commands:
+        if cmd.tag is None:
+            continue
+        id_ = cmd.id if cmd.id is not None else get_meta(cmd.cell.source).get(cmd.meta_key)
+        ids = by_tag.setdefault((cmd.deck, cmd.tag), set())
+        if id_ is not None:
+            ids.add(id_)
+    
+    for (deck, tag), ids in by_tag.items():
+        moved_ids = set()
+        for (other_deck, other_tag), other_ids in by_tag.items():
+            if other_deck == deck and other_tag != tag:
+                moved_ids |= other_ids
+        tagged_ids = set(anki_find_notes(deck, tag))
+        anki_add_tags(sorted(ids - tagged_ids), tag)
+        anki_remove_tags(sorted((tagged_ids - ids) & moved_ids), tag)
+
+
 def commands_execute(file_nb_dict, commands):
     """This will execute given commands
     
     Params:
+        file_nb_dict (dict str->nbformat.notebooknode.NotebookNode):
+            dict mapping .ipynb file paths to notebook objects
         commands (list-of-mbrain.Command)
     """
     for cmd in commands:
         print('Executing:', cmd.cmd, cmd.head)
         _exec_command(cmd)
-        
+    _update_tags(commands)
+    
+    _write_notebooks(file_nb_dict, commands)
+
+
+def _write_notebooks(file_nb_dict, commands):
+    """Write back notebooks for which commands changed cell metadata."""
+    import nbformat  # deferred, heavy import
+    
     changed_files = {cmd.notebook_filepath for cmd in commands if cmd.notebook_changed}
         
     for fl, nb in file_nb_dict.items():
@@ -217,3 +563,75 @@ def commands_execute(file_nb_dict, commands):
             print('Writing:', fl)
             with open(fl, 'w') as f:
                 nbformat.write(nb, f)
+
+
+def commands_stream(notebook_filepaths, anki_deck_name, dbg_print=False, renderer=None,
+                    validate=True):
+    """Sync notebooks one at a time: read, prepare, execute, write back.
+    
+    Unlike read_notebooks() + commands_prepare() + commands_execute(), this
+    only keeps one notebook (and its commands) in memory at a time, so peak
+    memory does not grow with number of notebooks, and first notebooks
+    are already synced while later ones are not even read yet.
+    
+    Note there is no chance to review commands before they are executed,
+    and Anki deck may be left partially synced if exception is raised.
+    Notebook is always written back, so IDs of notes already added from
+    it are kept even if later command fails.
+    
+    With validate, each notebook is pre-flight checked before any of its
+    commands is executed (see commands_prepare()), and ValueError is raised
+    if Anki would reject any card. Notebooks before it stay synced.
+    
+    Params:
+        notebook_filepaths (list-of-str): .ipynb files to sync,
+            see read_notebook_filepaths()
+        anki_deck_name (str): deck name in Anki database to sync to
+        dbg_print (bool): if True, print debug info
+        renderer (str or None): markdown renderer backend, see process_cell()
+        validate (bool): if True, pre-flight check new cards of each notebook
+    
+    Returns:
+        num_cards (int): number of flashcards found in notebooks
+        num_synced (int): number of non-noop commands executed
+        orphaned_ids (set-of-str): note IDs in Anki deck not present in notebooks
+    """
+    assert isinstance(notebook_filepaths, list)
+    assert isinstance(anki_deck_name, str)
+    assert isinstance(dbg_print, bool)
+    
+    existing_note_ids = anki_find_notes(anki_deck_name)
+    assert len(existing_note_ids) == len(set(existing_note_ids))
+    existing_note_ids = set(existing_note_ids)
+    
+    orphaned_ids = set(existing_note_ids)
+    num_cards = 0
+    num_synced = 0
+    
+    for filename in notebook_filepaths:
+        nb = read_notebook(filename)
+        commands = _prepare_notebook(filename, nb, anki_deck_name, existing_note_ids,
+                                     dbg_print, renderer)
+        
+        if validate:
+            rejected = _validate_commands(commands)
+            if len(rejected) != 0:
+                raise ValueError(f'Cards rejected by Anki pre-flight check in {filename}: '
+                                 + '; '.join(f'{cmd.head}: {cmd.error}' for cmd in rejected))
+        
+        try:
+            for cmd in commands:
+                if cmd.id is not None:   # add, add2
+                    orphaned_ids.remove(cmd.id)
+                print('Executing:', cmd.cmd, cmd.head)
+                _exec_command(cmd)
+                if cmd.cmd != 'noop':
+                    num_synced += 1
+            num_cards += len(commands)
+            _update_tags(commands)
+        finally:
+            # keep IDs of notes already added, even if some command failed
+            _write_notebooks({filename: nb}, commands)
+        del nb, commands  # drop notebook state before moving on
+    
+    return num_cards, num_synced, orphaned_ids
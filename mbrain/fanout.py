@@ -0,0 +1,143 @@
+"""Sync same notebooks to multiple Anki collections (AnkiConnect endpoints).
+
+Cards are rendered once, then prepared and executed against all endpoints
+concurrently, so each additional collection costs only its network I/O.
+
+Each endpoint keeps its own note IDs in cell <!--- ---> meta:
+ - endpoint named 'default' uses 'id' key, same as regular sync
+ - other endpoints use 'id@NAME' key, e.g. 'id@staging'
+
+Example meta:
+    <!--- {"id": "1560133178581", "id@staging": "1609542455713"} --->
+"""
+
+import collections
+import concurrent.futures
+
+from .anki import anki_bind_url
+from .anki import anki_connect_url
+from .anki import anki_find_notes
+from .jupyter import is_flashcard
+from .jupyter import process_cell
+from .convert import _exec_command
+from .convert import _update_tags
+from .convert import _write_notebooks
+from .convert import _find_orphaned_ids
+from .convert import _validate_commands
+from .convert import _figure_out_command
+
+
+Endpoint = collections.namedtuple('Endpoint', ('name', 'url'))
+
+
+def endpoint_meta_key(name):
+    """Key in cell meta holding note ID for endpoint with this name."""
+    if name == 'default':
+        return 'id'
+    return 'id@' + name
+
+
+def parse_endpoint(string):
+    """Parse 'NAME=URL' string, e.g. 'staging=http://localhost:8766'
+
+    Returns:
+        Endpoint: named tuple (name, url)
+    """
+    if '=' not in string:
+        raise ValueError(f'Endpoint must be in NAME=URL format: {string}')
+    name, url = string.split('=', 1)
+    if len(name) == 0 or '"' in name:
+        raise ValueError(f'Invalid endpoint name: {name}')
+    return Endpoint(name, url)
+
+
+def commands_prepare_fanout(file_nb_dict, anki_deck_name, endpoints, dbg_print=False,
+                            renderer=None, validate=False, num_workers=8):
+    """Render cards once and prepare commands to sync for every endpoint.
+
+    This function does not alter Anki databases or notes folder.
+
+    Params:
+        file_nb_dict (dict str->nbformat.notebooknode.NotebookNode):
+            dict mapping .ipynb file paths to notebook objects
+        anki_deck_name (str): deck name to sync to, must exist in all collections
+        endpoints (list-of-Endpoint): AnkiConnect endpoints to sync to
+        dbg_print (bool): if True, print debug info
+        renderer (str or None): markdown renderer backend, see process_cell()
+        validate (bool): if True, pre-flight check new cards, see commands_prepare()
+        num_workers (int): number of threads querying each endpoint
+
+    Returns:
+        dict str->tuple: endpoint name -> (commands, orphaned_ids),
+            see commands_prepare()
+    """
+    assert isinstance(file_nb_dict, dict)
+    assert isinstance(anki_deck_name, str)
+    assert len({ep.name for ep in endpoints}) == len(endpoints)
+
+    cards = []   # (filename, cell, meta, head, body, attachments)
+    for filename, nb in file_nb_dict.items():
+        if dbg_print: print('Processing:', filename)
+        for cell in nb['cells']:
+            if not is_flashcard(cell):
+                continue
+            meta, head, body, attachments = process_cell(cell, dbg_print, renderer)
+            cards.append((filename, cell, meta, head, body, attachments))
+
+    def prepare_endpoint(endpoint):
+        key = endpoint_meta_key(endpoint.name)
+
+        with anki_connect_url(endpoint.url):
+            note_ids = anki_find_notes(anki_deck_name)
+            assert len(note_ids) == len(set(note_ids))
+            note_ids = set(note_ids)
+
+        def lookup(card):
+            filename, cell, meta, head, body, attachments = card
+            endpoint_meta = {'id': meta[key]} if key in meta else {}
+            return _figure_out_command(endpoint_meta, head, body, note_ids,
+                                       deck=anki_deck_name, cell=cell, attachments=attachments,
+                                       filepath=filename, meta_key=key)
+
+        with anki_connect_url(endpoint.url):
+            lookup = anki_bind_url(lookup)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+            commands = list(executor.map(lookup, cards))
+
+        orphaned_ids = _find_orphaned_ids(note_ids, commands)
+
+        if validate:
+            with anki_connect_url(endpoint.url):
+                _validate_commands(commands)
+
+        return commands, orphaned_ids
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(endpoints)) as executor:
+        results = list(executor.map(prepare_endpoint, endpoints))
+
+    return {ep.name: res for ep, res in zip(endpoints, results)}
+
+
+def commands_execute_fanout(file_nb_dict, endpoints, plans):
+    """Execute commands on all endpoints concurrently, then write notebooks once.
+
+    Params:
+        file_nb_dict (dict str->nbformat.notebooknode.NotebookNode):
+            dict mapping .ipynb file paths to notebook objects
+        endpoints (list-of-Endpoint): AnkiConnect endpoints to sync to
+        plans (dict): as returned from commands_prepare_fanout()
+    """
+    def execute_endpoint(endpoint):
+        commands, _ = plans[endpoint.name]
+        with anki_connect_url(endpoint.url):
+            for cmd in commands:
+                print(f'[{endpoint.name}] Executing:', cmd.cmd, cmd.head)
+                _exec_command(cmd)
+            _update_tags(commands)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(endpoints)) as executor:
+        # list() to re-raise any exception from worker threads
+        list(executor.map(execute_endpoint, endpoints))
+
+    all_commands = [cmd for ep in endpoints for cmd in plans[ep.name][0]]
+    _write_notebooks(file_nb_dict, all_commands)
@@ -0,0 +1,89 @@
+"""Git helpers, used to sync only notebooks changed since last sync.
+
+Last synced commit is recorded per Anki deck inside notes repo .git folder,
+so it is never committed, e.g. '.git/mbrain_anki_sync.json':
+    {"Notes": "3f2a...", "Testing": "9b1c..."}
+"""
+
+import os
+import json
+import subprocess
+
+
+_state_filename = 'mbrain_anki_sync.json'
+
+
+def _git(folder, *args):
+    """Run git command in folder and return stdout lines."""
+    out = subprocess.check_output(['git'] + list(args), cwd=folder,
+                                  stderr=subprocess.DEVNULL)
+    return [line for line in out.decode().splitlines() if len(line) != 0]
+
+
+def git_is_repo(folder):
+    """True if folder is inside git working tree."""
+    try:
+        return _git(folder, 'rev-parse', '--is-inside-work-tree') == ['true']
+    except (subprocess.CalledProcessError, OSError):
+        return False
+
+
+def git_head(folder):
+    """Commit hash of HEAD of repo containing folder."""
+    return _git(folder, 'rev-parse', 'HEAD')[0]
+
+
+def git_is_commit(folder, rev):
+    """True if rev names existing commit, e.g. not lost after rebase and gc."""
+    try:
+        _git(folder, 'rev-parse', '--verify', '--quiet', rev + '^{commit}')
+        return True
+    except subprocess.CalledProcessError:
+        return False
+
+
+def git_changed_files(folder, since):
+    """Files changed since given revision, including uncommitted and untracked.
+
+    Params:
+        folder (str): folder inside git repo, e.g. notes folder
+        since (str): git revision, e.g. commit hash or 'HEAD~3'
+
+    Returns:
+        set-of-str: normalized paths relative to folder, e.g. {'DeepRL_Notes.ipynb'}
+    """
+    if not git_is_commit(folder, since):
+        raise ValueError(f'Not a commit in git repo: {since}')
+    changed = _git(folder, 'diff', '--name-only', '--relative', since)
+    untracked = _git(folder, 'ls-files', '--others', '--exclude-standard')
+    return {os.path.normpath(fp) for fp in changed + untracked}
+
+
+def git_dir(folder):
+    """Absolute path to .git folder of repo containing folder."""
+    return _git(folder, 'rev-parse', '--absolute-git-dir')[0]
+
+
+def _state_filepath(folder):
+    return os.path.join(git_dir(folder), _state_filename)
+
+
+def read_last_synced(folder, anki_deck_name):
+    """Commit recorded by write_last_synced() for this deck, or None."""
+    filepath = _state_filepath(folder)
+    if not os.path.exists(filepath):
+        return None
+    with open(filepath, 'r') as f:
+        return json.load(f).get(anki_deck_name)
+
+
+def write_last_synced(folder, anki_deck_name, commit):
+    """Record commit as last successfully synced to this deck."""
+    filepath = _state_filepath(folder)
+    state = {}
+    if os.path.exists(filepath):
+        with open(filepath, 'r') as f:
+            state = json.load(f)
+    state[anki_deck_name] = commit
+    with open(filepath, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
@@ -2,9 +2,9 @@ import re
 import json
 import hashlib
 import collections
+import html.parser
 
-import nbformat
-import nbconvert
+from .render import get_renderer
 
 def is_flashcard(cell):
     """Check if cell is a flashcard
@@ -62,27 +62,33 @@ def get_meta(string):
         return json.loads(meta)
 
     
-def put_meta(string, anki_id):
+def put_meta(string, anki_id, key='id'):
     """Replace current Anki metadata with new params.
     
+    Other keys already in metadata (e.g. IDs in other Anki collections,
+    see mbrain.fanout) are kept.
+    
     Params:
         string (str): input, e.g. '<!---Anki meta---> rest of card.'
+        anki_id (str): note ID to put into metadata
+        key (str): metadata key, 'id' for default Anki collection
     
     Returns:
         str: new meta, e.g. '<!---new Anki meta--->'    
     """
     assert isinstance(anki_id, str)
     
-    meta_str = json.dumps({"id":anki_id})
-    meta_str = '<!--- ' + meta_str + ' --->'
-    meta_list = list(meta_str)
-    
     string_list = list(string)
     for match in re.finditer(_pattern_meta, string):
         start = match.start()
         end = match.end()
         
-        string_list[start:end] = meta_list
+        meta = get_meta(match.group(0))
+        meta[key] = anki_id
+        meta_str = json.dumps(meta)
+        meta_str = '<!--- ' + meta_str + ' --->'
+        
+        string_list[start:end] = list(meta_str)
         
         break # consider first <!--- ---> only
     
@@ -238,19 +244,12 @@ def replace_single_dollars(string):
          ignore preceeding '\' so this displayes correctly in browser,
          but Anki displays leading '\', so we need to process further
     """
-    # Because we replace single char '$' with dual char '\(' and '\)'
-    # we have to iterate list backward so we don't offset indices
-    matches = []
-    for match in re.finditer(pattern_sido, string):
-        matches.append(match)
-    
-    string_list = list(string)
-    for match in reversed(matches):
-        end = match.end()
-        string_list[end-1:end] = ['\\', ')']
-        start = match.start()
-        string_list[start:start+1] = ['\\', '(']
-    return ''.join(string_list)
+    # Replace leading '$' with '\(' and trailing '$' with '\)' in every match.
+    # Note: inserting into list in-place (as before) is O(n) per match, which
+    # made this quadratic on cells with many inline math expressions
+    def replace(match):
+        return '\\(' + match.group(0)[1:-1] + '\\)'
+    return re.sub(pattern_sido, replace, string)
 
 # s = r'adfsa flaj <span>\$</span>30 sdfkla $ x = 3 $ $ y = 2 $.'
 # r = replace_single_dollars(s)
@@ -406,10 +405,138 @@ def replace_image_tags(string_html, attachment_name, attachment_sha256):
     return re.sub(pattern, target, string_html)
 
 
+# Whitespace around these tags is not rendered, so it can be dropped
+_block_tags = {
+    'address', 'article', 'aside', 'blockquote', 'div', 'dl', 'dt', 'dd',
+    'fieldset', 'figure', 'footer', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'header', 'hr', 'li', 'main', 'nav', 'ol', 'p', 'pre', 'section',
+    'table', 'tbody', 'thead', 'tfoot', 'tr', 'td', 'th', 'ul',
+}
+
+# Elements without closing tag
+_void_tags = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+              'link', 'meta', 'source', 'track', 'wbr'}
+
+# Only ASCII whitespace, note '\s' would also match non-breaking space
+_pattern_ws = r'[ \t\n\r\f]+'
+
+
+def _escape_text(string):
+    return string.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _escape_attr(string):
+    return string.replace('&', '&amp;').replace('"', '&quot;')
+
+
+def _normalize_style(style):
+    """Canonical css style attribute, e.g. 'text-align:left;' -> 'text-align: left'"""
+    decls = []
+    for decl in style.split(';'):
+        if ':' not in decl:
+            continue
+        prop, value = decl.split(':', 1)
+        decls.append(prop.strip().lower() + ': ' + ' '.join(value.split()))
+    return '; '.join(decls)
+
 
+class _HTMLNormalizer(html.parser.HTMLParser):
+    """Collects tokens for normalize_html(), see there."""
+    
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.tokens = []   # list of (kind, tag_or_text, serialized)
+    
+    def handle_starttag(self, tag, attrs):
+        parts = [tag]
+        for name, value in sorted(attrs):
+            if value is None:
+                parts.append(name)
+            else:
+                if name == 'style':
+                    value = _normalize_style(value)
+                elif name == 'class':
+                    value = ' '.join(value.split())
+                parts.append(f'{name}="{_escape_attr(value)}"')
+        self.tokens.append(('start', tag, '<' + ' '.join(parts) + '>'))
+        if tag in _void_tags:
+            self.tokens.append(('end', tag, ''))
+    
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in _void_tags:
+            self.handle_endtag(tag)
+    
+    def handle_endtag(self, tag):
+        if tag in _void_tags:
+            return  # already closed, e.g. stray </br>
+        self.tokens.append(('end', tag, f'</{tag}>'))
+    
+    def handle_data(self, data):
+        if self.cdata_elem is not None:   # inside <script> or <style>
+            self.tokens.append(('raw', None, data))
+        elif len(self.tokens) != 0 and self.tokens[-1][0] == 'text':
+            # merge with previous text, e.g. text split by removed comment
+            self.tokens[-1] = ('text', None, self.tokens[-1][2] + data)
+        else:
+            self.tokens.append(('text', None, data))
+
+
+def normalize_html(string_html):
+    """Canonical, whitespace-minimized form of html, for comparison and storage.
+    
+    Anki and its editor rewrite html of stored fields (attribute order,
+    entities, whitespace, style attributes), so rendered body must not be
+    compared with Anki field as plain string. Two html strings which render
+    the same should normalize to the same string, and normalize_html() is
+    idempotent, i.e. normalize_html(normalize_html(x)) == normalize_html(x)
+    
+    This will:
+     - lowercase tag and attribute names, sort attributes, quote with '"'
+     - normalize 'style' and 'class' attribute values
+     - decode all entities and re-escape only '&', '<', '>' (and '"' in attributes)
+     - remove html comments
+     - collapse whitespace runs into single space and remove whitespace
+       next to block tags (e.g. <div>, <p>, <li>), except inside <pre>
+    
+    Params:
+        string_html (str): html, e.g. cell body or Anki note field
+    
+    Returns:
+        str: normalized html
+    """
+    parser = _HTMLNormalizer()
+    parser.feed(string_html)
+    parser.close()
+    tokens = parser.tokens
+    
+    def is_block(i):
+        return 0 <= i < len(tokens) and tokens[i][0] in {'start', 'end'} \
+            and tokens[i][1] in _block_tags
+    
+    out = []
+    pre_depth = 0
+    for i, (kind, tag, string) in enumerate(tokens):
+        if kind == 'start' and tag == 'pre':
+            pre_depth += 1
+        elif kind == 'end' and tag == 'pre':
+            pre_depth = max(0, pre_depth - 1)
+        
+        if kind == 'text':
+            if pre_depth == 0:
+                string = re.sub(_pattern_ws, ' ', string)
+                if i == 0 or is_block(i - 1):
+                    string = string.lstrip(' ')
+                if i == len(tokens) - 1 or is_block(i + 1):
+                    string = string.rstrip(' ')
+            string = _escape_text(string)
+        
+        out.append(string)
+    
+    return ''.join(out)
 
 
-def process_cell(cell, dbg_print=False):
+def process_cell(cell, dbg_print=False, renderer=None):
     """Extract meta, head, body and attachments from Jupyter cell
     
     This will:
@@ -417,12 +544,13 @@ def process_cell(cell, dbg_print=False):
      - extract and remove question from **...** tag from cell.source
        + convert $..$ into \(..\) in head
      - extract any attachments mentioned in ![...](...) tags in cell.source
-     - convert remaining Markdown cell.source into HTML
+     - convert remaining Markdown cell.source into HTML, see mbrain.render
      - convert HTML as follows:
        + convert double $$..$$ blocks into \[..\]
        + convert single $..$ blocks into \(..\)
        + convert escaped dollars '<span>\$</span>' into '$'
        + replace <img src="attachment:..."> with <img src="SHA256">
+       + normalize html, see normalize_html()
     
     Example source:
         <!---{"id":"1234567890"}--->
@@ -444,11 +572,15 @@ def process_cell(cell, dbg_print=False):
     Params:
         source (str): cell source
         dbg_print (bool): if True print debug
+        renderer (str or None): markdown renderer backend, 'mistune' or 'nbconvert',
+            None means default, see mbrain.render.get_renderer()
     
     Returns:
         meta (dict) - Anki metadata as dict
     """
     
+    import nbformat  # deferred, heavy import
+    
     assert isinstance(cell, nbformat.notebooknode.NotebookNode)
     source = cell.source
     
@@ -469,15 +601,7 @@ def process_cell(cell, dbg_print=False):
     attachments = get_attachments(cell)
     
     # Convert to HTML
-    tmp_nb = nbformat.v4.new_notebook()
-    if 'attachments' in cell:
-        tmp_cell = nbformat.v4.new_markdown_cell(source=source, attachments=dict(cell.attachments))
-    else:
-        tmp_cell = nbformat.v4.new_markdown_cell(source=source)
-    tmp_nb['cells'].append(tmp_cell)
-    html_exporter = nbconvert.HTMLExporter()
-    html_exporter.template_file = 'basic'
-    body_raw, _ = html_exporter.from_notebook_node(tmp_nb)
+    body_raw = get_renderer(renderer).render(source, cell.get('attachments'))
     
     # Replace $$...$$ with \[...\]
     body_nodd = replace_double_dollars(body_raw)
@@ -495,4 +619,7 @@ def process_cell(cell, dbg_print=False):
     for name, (sha256, value) in attachments.items():
         body = replace_image_tags(body, name, sha256)
     
+    # Canonical compact html, same form as used to compare with Anki
+    body = normalize_html(body)
+    
     return meta, head, body, attachments
@@ -0,0 +1,186 @@
+"""IPython %anki_sync magic, syncs notebooks to Anki from inside Jupyter.
+
+Usage in notebook:
+    %load_ext mbrain.magic
+    %anki_sync Notes.ipynb --deck Notes   # sync given notebook
+    %anki_sync --all                      # sync all notebooks in anki_sync.txt
+    %anki_sync -y                         # sync current notebook, don't ask
+
+Notes folder is first folder containing 'anki_sync.txt', searching upwards
+from kernel working directory, unless --folder or MBRAIN_NOTES_FOLDER env
+variable is given. Deck defaults to MBRAIN_ANKI_DECK env variable.
+Folder and deck are remembered for next calls.
+
+Current notebook path is taken from JPY_SESSION_NAME env variable, which
+is set by newer Jupyter servers (jupyter_server 2.x). Otherwise, e.g. on
+notebook 6.x server used by jupyterlab 2.x, kernel ID is looked up in
+running server /api/sessions. This needs token auth (as in run_jupyter_*.bash
+scripts), with password-only server pass notebook path explicitly.
+
+Syncer object (see mbrain.Syncer) is kept between calls, so repeated syncs
+reuse parsed notebooks, rendered cards and Anki deck snapshot.
+"""
+
+import os
+import json
+import shlex
+import argparse
+import importlib
+import urllib.request
+
+from .syncer import Syncer
+
+
+_syncer = None
+
+
+def _find_notes_folder(start):
+    """First folder containing anki_sync.txt, searching upwards, or None."""
+    folder = os.path.abspath(start)
+    while True:
+        if os.path.exists(os.path.join(folder, 'anki_sync.txt')):
+            return folder
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            return None
+        folder = parent
+
+
+def _parse_args(line):
+    parser = argparse.ArgumentParser(prog='%anki_sync')
+    parser.add_argument('notebook', nargs='?',
+                        help='Notebook to sync, default is current notebook')
+    parser.add_argument('--all', action='store_true',
+                        help='Sync all notebooks listed in anki_sync.txt')
+    parser.add_argument('--deck', help='Anki deck name')
+    parser.add_argument('--folder', help='Notes folder with anki_sync.txt')
+    parser.add_argument('--refresh', action='store_true',
+                        help='Re-read deck state from Anki, if notes were changed in Anki')
+    parser.add_argument('-y', '--yes', action='store_true',
+                        help='Execute without asking')
+    return parser.parse_args(shlex.split(line))
+
+
+def _get_syncer(folder, deck):
+    """Create Syncer on first use, re-create if folder or deck changed."""
+    global _syncer
+
+    if folder is None:
+        folder = os.environ.get('MBRAIN_NOTES_FOLDER')
+    if folder is None and _syncer is not None:
+        folder = _syncer.notes_folder_location
+    if folder is None:
+        folder = _find_notes_folder(os.getcwd())
+    if folder is None:
+        raise ValueError('Could not find anki_sync.txt, use --folder.')
+
+    if deck is None:
+        deck = os.environ.get('MBRAIN_ANKI_DECK')
+    if deck is None and _syncer is not None:
+        deck = _syncer.anki_deck_name
+    if deck is None:
+        raise ValueError('Please specify Anki deck with --deck.')
+
+    if _syncer is None or _syncer.notes_folder_location != folder \
+            or _syncer.anki_deck_name != deck:
+        _syncer = Syncer(folder, deck)
+    return _syncer
+
+
+def _session_notebook():
+    """Current notebook from running Jupyter servers /api/sessions, or None."""
+    try:
+        import ipykernel.connect
+        connection_file = ipykernel.connect.get_connection_file()
+    except Exception:
+        return None   # not running inside kernel
+    # e.g. '/../runtime/kernel-2b1c...-9f.json'
+    kernel_id = os.path.basename(connection_file)[len('kernel-'):-len('.json')]
+
+    servers = []
+    for module_name in ['jupyter_server.serverapp', 'notebook.notebookapp']:
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            continue
+        servers.extend(module.list_running_servers())
+
+    for server in servers:
+        url = server['url'] + 'api/sessions'
+        if server.get('token'):
+            url += '?token=' + server['token']
+        try:
+            with urllib.request.urlopen(url, timeout=2) as f:
+                sessions = json.load(f)
+        except Exception:
+            continue   # e.g. password protected or stopped server
+        for session in sessions:
+            if session['kernel']['id'] == kernel_id:
+                path = session.get('path') or session['notebook']['path']
+                root = server.get('root_dir') or server.get('notebook_dir')
+                return os.path.join(root, path)
+    return None
+
+
+def _current_notebook():
+    session_name = os.environ.get('JPY_SESSION_NAME')
+    if session_name is not None and session_name.endswith('.ipynb'):
+        if not os.path.isabs(session_name):
+            # relative to server root, but kernel runs in notebook folder
+            session_name = os.path.join(os.getcwd(), os.path.basename(session_name))
+        return session_name
+
+    # older servers do not set JPY_SESSION_NAME
+    notebook = _session_notebook()
+    if notebook is None:
+        raise ValueError('Could not determine current notebook (password protected '
+                         'Jupyter server?), pass notebook path or use --all.')
+    return notebook
+
+
+def anki_sync(line):
+    """Sync current (or given, or all) notebook to Anki, see module docstring."""
+    args = _parse_args(line)
+    syncer = _get_syncer(args.folder, args.deck)
+
+    if args.refresh:
+        syncer.refresh()
+
+    if args.all:
+        notebook_filepaths = None
+    else:
+        notebook = args.notebook if args.notebook is not None else _current_notebook()
+        notebook_filepaths = [os.path.abspath(notebook)]
+
+    commands, orphan_ids = syncer.prepare(notebook_filepaths, validate=True)
+
+    pending = [c for c in commands if c.cmd != 'noop']
+    print('Num cards:', len(commands), ' require sync:', len(pending),
+          ' orphaned in Anki:', len(orphan_ids))
+    for c in pending:
+        print(' * ' + c.cmd + ': ' + c.head)
+
+    rejected = [c for c in commands if c.error is not None]
+    if len(rejected) != 0:
+        print('Cards rejected by Anki pre-flight check:')
+        for c in rejected:
+            print(' ! ' + c.notebook_filepath + ': ' + c.head)
+            print('     ' + c.error)
+        print('Aborted, nothing was done.')
+        return
+
+    if len(pending) == 0:
+        return
+
+    if not args.yes and input('Execute commands? [y/N]:') != 'y':
+        print('Aborted, nothing was done.')
+        return
+
+    syncer.execute(commands)
+    if any(c.notebook_changed for c in commands):
+        print('Notebooks updated with new note IDs, reload them from disk.')
+
+
+def load_ipython_extension(ipython):
+    """Called by %load_ext mbrain.magic"""
+    ipython.register_magic_function(anki_sync, 'line', 'anki_sync')
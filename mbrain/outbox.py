@@ -0,0 +1,404 @@
+"""Offline outbox, queues sync when Anki is not reachable.
+
+'jupyanki.py sync --queue' renders cards and stores them in local SQLite
+outbox, without talking to Anki at all. 'jupyanki.py flush' later sends
+queued notes and media to AnkiConnect in large 'multi' batches, without
+rendering anything again. Notebooks are only opened to check queued cards
+were not edited since, and to write back IDs of newly added notes.
+
+Outbox is '.git/mbrain_outbox.sqlite' if notes folder is in git repo
+(so it is never committed), otherwise '.mbrain_outbox.sqlite' in notes folder.
+
+Cards are keyed by note ID from <!--- ---> meta, or by notebook and cell
+source for new cards. Card is not queued again if its content hash did
+not change since it was queued, or since it was last flushed. Regular
+online sync drops queued cards of synced notebooks, see outbox_drop().
+
+Example:
+    import mbrain as mb
+    filepath = mb.outbox_default_filepath('/mnt/marcin-notes')
+    mb.outbox_queue(filepath, mb.read_notebooks('/mnt/marcin-notes'), 'Notes')
+    ...  # later, when Anki is running
+    commands = mb.outbox_flush(filepath)
+"""
+
+import os
+import json
+import sqlite3
+import hashlib
+
+from .jupyter import get_meta
+from .jupyter import put_meta
+from .jupyter import remove_meta
+from .jupyter import is_flashcard
+from .jupyter import process_cell
+from .jupyter import normalize_html
+from .anki import _build_note
+from .anki import anki_multi
+from .anki import anki_get_notes
+from .git import git_dir
+from .git import git_is_repo
+
+
+_schema = """
+CREATE TABLE IF NOT EXISTS outbox (
+    key TEXT PRIMARY KEY,        -- note ID, or 'new:<notebook>:<cell hash>'
+    hash TEXT NOT NULL,          -- content hash, see _card_hash()
+    note_id TEXT,                -- None for new cards
+    deck TEXT NOT NULL,
+    front TEXT NOT NULL,
+    back TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    notebook_filepath TEXT NOT NULL,
+    cell_hash TEXT NOT NULL,     -- hash of cell source without meta
+    media TEXT NOT NULL          -- JSON list of media names
+);
+CREATE TABLE IF NOT EXISTS media (
+    name TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS flushed (
+    note_id TEXT PRIMARY KEY,
+    hash TEXT NOT NULL
+);
+"""
+
+
+def outbox_default_filepath(notes_folder_location):
+    """Outbox location for notes folder, see module docstring."""
+    if git_is_repo(notes_folder_location):
+        return os.path.join(git_dir(notes_folder_location), 'mbrain_outbox.sqlite')
+    return os.path.join(notes_folder_location, '.mbrain_outbox.sqlite')
+
+
+def _open(outbox_filepath):
+    conn = sqlite3.connect(outbox_filepath)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(_schema)
+    return conn
+
+
+def _sha256(string):
+    return hashlib.sha256(string.encode('utf-8')).hexdigest()
+
+
+def _card_hash(deck, front, back, tag, media_names):
+    return _sha256(json.dumps([deck, front, back, tag, sorted(media_names)]))
+
+
+def _cell_hash(source):
+    return _sha256(remove_meta(source))
+
+
+def _batches(items, batch_size):
+    for i in range(0, len(items), batch_size):
+        yield items[i:i+batch_size]
+
+
+def outbox_queue(outbox_filepath, file_nb_dict, anki_deck_name, dbg_print=False,
+                 renderer=None):
+    """Render flashcards and store ones which changed in outbox.
+
+    Does not connect to Anki. Queued new cards which are no longer in their
+    notebook (e.g. edited again before flush) are dropped from outbox.
+
+    Params:
+        outbox_filepath (str): SQLite file, created if does not exist
+        file_nb_dict (dict str->nbformat.notebooknode.NotebookNode):
+            dict mapping .ipynb file paths to notebook objects
+        anki_deck_name (str): deck name in Anki database to sync to
+        dbg_print (bool): if True, print debug info
+        renderer (str or None): markdown renderer backend, see process_cell()
+
+    Returns:
+        num_cards (int): number of flashcards found in notebooks
+        num_queued (int): number of cards added or replaced in outbox
+    """
+    from .convert import notebook_tag  # avoid import cycle
+
+    assert isinstance(file_nb_dict, dict)
+    assert isinstance(anki_deck_name, str)
+
+    num_cards = 0
+    num_queued = 0
+
+    conn = _open(outbox_filepath)
+    try:
+        queued = {r['key']: r['hash'] for r in conn.execute('SELECT key, hash FROM outbox')}
+        flushed = {r['note_id']: r['hash'] for r in conn.execute('SELECT note_id, hash FROM flushed')}
+
+        for filename, nb in file_nb_dict.items():
+            if dbg_print: print('Processing:', filename)
+            tag = notebook_tag(filename)
+            new_keys = []
+
+            for cell in nb['cells']:
+                if not is_flashcard(cell):
+                    continue
+                num_cards += 1
+
+                meta, head, body, attachments = process_cell(cell, dbg_print, renderer)
+                media = {key: value for name, (key, value) in attachments.items()}
+                hash_ = _card_hash(anki_deck_name, head, body, tag, media)
+                cell_hash = _cell_hash(cell.source)
+
+                note_id = meta.get('id')
+                if note_id is not None:
+                    key = note_id
+                    if flushed.get(note_id) == hash_:
+                        continue  # already in Anki
+                else:
+                    key = 'new:' + filename + ':' + cell_hash
+                    new_keys.append(key)
+
+                if queued.get(key) == hash_:
+                    continue  # already queued
+
+                conn.execute('INSERT OR REPLACE INTO outbox VALUES (?,?,?,?,?,?,?,?,?,?)',
+                             (key, hash_, note_id, anki_deck_name, head, body, tag,
+                              filename, cell_hash, json.dumps(sorted(media))))
+                conn.executemany('INSERT OR IGNORE INTO media VALUES (?,?)', media.items())
+                queued[key] = hash_
+                num_queued += 1
+
+            # new cards queued earlier, but since edited or removed from notebook
+            stale_keys = [r['key'] for r in conn.execute(
+                'SELECT key FROM outbox WHERE note_id IS NULL AND notebook_filepath = ?',
+                (filename,)) if r['key'] not in new_keys]
+            conn.executemany('DELETE FROM outbox WHERE key = ?', [(k,) for k in stale_keys])
+
+        conn.commit()
+    finally:
+        conn.close()
+
+    return num_cards, num_queued
+
+
+def outbox_pending(outbox_filepath):
+    """Cards waiting in outbox.
+
+    Returns:
+        list-of-tuple: (note_id, front) pairs, note_id is None for new cards
+    """
+    if not os.path.exists(outbox_filepath):
+        return []
+    conn = _open(outbox_filepath)
+    try:
+        return [(r['note_id'], r['front'])
+                for r in conn.execute('SELECT note_id, front FROM outbox ORDER BY rowid')]
+    finally:
+        conn.close()
+
+
+def _index_cells(nb):
+    """Flashcard cells by note ID and by 'hash:<cell hash>', see _find_cell()"""
+    index = {}
+    for cell in nb['cells']:
+        if not is_flashcard(cell):
+            continue
+        note_id = get_meta(cell.source).get('id')
+        if note_id is not None:
+            index[note_id] = cell
+        index['hash:' + _cell_hash(cell.source)] = cell
+    return index
+
+
+def _find_cell(index, row):
+    """Cell queued as row, or None if it was edited or removed since queued."""
+    if row['note_id'] is not None:
+        cell = index.get(row['note_id'])
+    else:
+        cell = index.get('hash:' + row['cell_hash'])
+    if cell is None or _cell_hash(cell.source) != row['cell_hash']:
+        return None
+    return cell
+
+
+def outbox_drop(outbox_filepath, notebook_filepaths):
+    """Drop queued cards of notebooks which were just synced online.
+
+    Call after regular sync executed, Anki then already holds current content
+    of these notebooks, so flushing older queued content would overwrite it.
+    Drops cards queued from these notebooks, and cards with note IDs now in
+    these notebooks (moved from other notebook). Does nothing if outbox does
+    not exist.
+
+    Params:
+        outbox_filepath (str): SQLite file, see outbox_queue()
+        notebook_filepaths (list-of-str): .ipynb files just synced
+
+    Returns:
+        int: number of cards dropped from outbox
+    """
+    from .convert import read_note_ids  # avoid import cycle
+
+    if not os.path.exists(outbox_filepath):
+        return 0
+
+    note_ids = set()
+    for filepath in notebook_filepaths:
+        note_ids |= read_note_ids(filepath)
+
+    conn = _open(outbox_filepath)
+    try:
+        num_before = conn.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+        conn.executemany('DELETE FROM outbox WHERE notebook_filepath = ?',
+                         [(fp,) for fp in notebook_filepaths])
+        conn.executemany('DELETE FROM outbox WHERE note_id = ?', [(id_,) for id_ in note_ids])
+        # Anki no longer holds last flushed content of these notes
+        conn.executemany('DELETE FROM flushed WHERE note_id = ?', [(id_,) for id_ in note_ids])
+        num_after = conn.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+        _delete_unused_media(conn)
+        conn.commit()
+    finally:
+        conn.close()
+
+    return num_before - num_after
+
+
+def _delete_unused_media(conn):
+    used_media = set()
+    for r in conn.execute('SELECT media FROM outbox'):
+        used_media |= set(json.loads(r['media']))
+    unused_media = [r['name'] for r in conn.execute('SELECT name FROM media')
+                    if r['name'] not in used_media]
+    conn.executemany('DELETE FROM media WHERE name = ?', [(n,) for n in unused_media])
+
+
+def outbox_flush(outbox_filepath, batch_size=500):
+    """Send cards queued in outbox to Anki, in batches of 'multi' requests.
+
+    Queued notes are fetched from Anki in batches and compared (after
+    normalize_html()), so only changed notes are updated. Missing notes are
+    added and their new IDs written back into notebooks. Media are stored
+    for every added or updated note. Successfully sent cards are removed
+    from outbox, failed ones stay there for next flush.
+
+    Cards edited or removed in notebook since they were queued are never
+    sent, as notebook (or Anki, if synced online since) has newer content.
+    They are dropped from outbox with Command.error set.
+
+    Params:
+        outbox_filepath (str): SQLite file, see outbox_queue()
+        batch_size (int): max number of notes or actions per request
+
+    Returns:
+        list-of-mbrain.Command: one command per queued card, failed ones
+            have Command.error set
+    """
+    from .convert import Command  # avoid import cycle
+    from .convert import read_notebook
+    from .convert import _write_notebooks
+
+    assert batch_size >= 1
+
+    if not os.path.exists(outbox_filepath):
+        return []
+
+    conn = _open(outbox_filepath)
+    try:
+        rows = conn.execute('SELECT * FROM outbox ORDER BY rowid').fetchall()
+
+        note_ids = [r['note_id'] for r in rows if r['note_id'] is not None]
+        current = {}
+        for batch in _batches(note_ids, batch_size):
+            current.update(anki_get_notes(batch))
+
+        file_nb_dict = {}
+        cell_index = {}
+        commands = []
+        stale_keys = []
+        for row in rows:
+            note_id = row['note_id']
+            card = {'deck': row['deck'], 'filepath': row['notebook_filepath']}
+            if note_id is not None and note_id in current:
+                front, back = current[note_id]
+                if normalize_html(front) != normalize_html(row['front']) \
+                        or normalize_html(back) != normalize_html(row['back']):
+                    cmd = Command('update', note_id, row['front'], row['back'], **card)
+                else:
+                    cmd = Command('noop', note_id, row['front'], row['back'], **card)
+            else:
+                name = 'add' if note_id is None else 'add2'
+                cmd = Command(name, None, row['front'], row['back'], **card)
+
+            # cell is needed to check card is unchanged, and to write back new note ID
+            filepath = row['notebook_filepath']
+            if filepath not in file_nb_dict and os.path.exists(filepath):
+                file_nb_dict[filepath] = read_notebook(filepath)
+                cell_index[filepath] = _index_cells(file_nb_dict[filepath])
+            if filepath in cell_index:
+                cmd.cell = _find_cell(cell_index[filepath], row)
+            if cmd.cell is None:
+                cmd.error = 'card changed or removed since queued, dropped, sync again'
+                stale_keys.append(row['key'])
+            elif cmd.cmd == 'add' and 'id' in get_meta(cmd.cell.source):
+                # already synced online since it was queued
+                cmd = Command('noop', get_meta(cmd.cell.source)['id'],
+                              row['front'], row['back'], **card)
+            commands.append(cmd)
+
+        # Media first, so new notes never reference missing files
+        media_names = set()
+        for row, cmd in zip(rows, commands):
+            if cmd.cmd in {'add', 'add2', 'update'} and cmd.error is None:
+                media_names |= set(json.loads(row['media']))
+        media_actions = []
+        for name in sorted(media_names):
+            data = conn.execute('SELECT data FROM media WHERE name = ?', (name,)).fetchone()[0]
+            media_actions.append(('storeMediaFile', {'filename': name, 'data': data}))
+        for batch in _batches(media_actions, batch_size):
+            for result, error in anki_multi(batch):
+                if error is not None:
+                    raise Exception('storeMediaFile failed: ' + error)
+
+        actions = []   # (action, params, command)
+        for cmd in commands:
+            if cmd.error is not None:
+                continue
+            if cmd.cmd in {'add', 'add2'}:
+                note = _build_note(cmd.deck, cmd.head, cmd.body, [cmd.tag])
+                actions.append(('addNote', {'note': note}, cmd))
+            elif cmd.cmd == 'update':
+                note = {'id': cmd.id, 'fields': {'Front': cmd.head, 'Back': cmd.body}}
+                actions.append(('updateNoteFields', {'note': note}, cmd))
+
+        for batch in _batches(actions, batch_size):
+            results = anki_multi([(action, params) for action, params, cmd in batch])
+            for (action, params, cmd), (result, error) in zip(batch, results):
+                if error is not None:
+                    cmd.error = error
+                    continue
+                print('Executing:', cmd.cmd, cmd.head)
+                if cmd.cmd in {'add', 'add2'}:
+                    new_source = put_meta(cmd.cell.source, str(result))
+                    if cmd.cell.source != new_source:
+                        cmd.cell.source = new_source
+                        cmd.notebook_changed = True
+
+        # Notes which existed already may come from before notebook tags
+        by_tag = {}
+        for cmd in commands:
+            if cmd.cmd in {'update', 'noop'} and cmd.error is None:
+                by_tag.setdefault(cmd.tag, []).append(cmd.id)
+        tag_actions = [('addTags', {'notes': ids, 'tags': tag})
+                       for tag, ids in by_tag.items() if tag is not None]
+        for batch in _batches(tag_actions, batch_size):
+            anki_multi(batch)
+
+        _write_notebooks(file_nb_dict, commands)
+
+        for row, cmd in zip(rows, commands):
+            if cmd.error is not None:
+                continue
+            note_id = cmd.id if cmd.cell is None else get_meta(cmd.cell.source).get('id')
+            conn.execute('DELETE FROM outbox WHERE key = ?', (row['key'],))
+            if note_id is not None:
+                conn.execute('INSERT OR REPLACE INTO flushed VALUES (?,?)', (note_id, row['hash']))
+        conn.executemany('DELETE FROM outbox WHERE key = ?', [(k,) for k in stale_keys])
+        _delete_unused_media(conn)
+        conn.commit()
+    finally:
+        conn.close()
+
+    return commands
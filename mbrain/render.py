@@ -0,0 +1,100 @@
+"""Markdown -> HTML renderers for flashcard bodies.
+
+Two interchangeable backends are provided:
+ - 'nbconvert': reference backend, wraps cell in temporary notebook and runs
+   full nbconvert HTMLExporter with 'basic' template
+ - 'mistune': fast backend, calls nbconvert's mistune markdown engine directly
+   (same math lexers and attachment handling as HTMLExporter uses internally)
+   and adds the same wrapper <div>s the 'basic' template would
+
+Both produce identical output, see scripts/check_renderers.py
+"""
+
+# Static parts of nbconvert 'basic' template (markdowncell block and
+# notebook footer) which surround the rendered markdown
+_basic_prefix = ('<div class="cell border-box-sizing text_cell rendered">'
+                 '<div class="prompt input_prompt">\n'
+                 '</div><div class="inner_cell">\n'
+                 '<div class="text_cell_render border-box-sizing rendered_html">\n')
+_basic_suffix = '\n</div>\n</div>\n</div>\n \n\n'
+
+
+class NbconvertRenderer:
+    """Reference renderer, full nbconvert HTMLExporter with 'basic' template."""
+
+    def __init__(self):
+        import nbconvert  # deferred, pulls in jinja, mistune, pygments, etc.
+        self.html_exporter = nbconvert.HTMLExporter()
+        self.html_exporter.template_file = 'basic'
+
+    def render(self, source, attachments=None):
+        """Render markdown cell source into HTML.
+
+        Params:
+            source (str): markdown source, with meta and head already removed
+            attachments (dict or None): Jupyter cell attachments, if any
+
+        Returns:
+            str: cell converted to html
+        """
+        import nbformat  # deferred, heavy import
+
+        tmp_nb = nbformat.v4.new_notebook()
+        if attachments is not None:
+            tmp_cell = nbformat.v4.new_markdown_cell(source=source, attachments=dict(attachments))
+        else:
+            tmp_cell = nbformat.v4.new_markdown_cell(source=source)
+        tmp_nb['cells'].append(tmp_cell)
+        body_raw, _ = self.html_exporter.from_notebook_node(tmp_nb)
+        return body_raw
+
+
+class MistuneRenderer:
+    """Fast renderer, mistune with Jupyter math and attachments, no exporter."""
+
+    def __init__(self):
+        # deferred, heavy imports
+        from nbconvert.filters.markdown_mistune import MarkdownWithMath
+        from nbconvert.filters.markdown_mistune import IPythonRenderer
+        from nbconvert.filters.strings import strip_files_prefix
+        self._MarkdownWithMath = MarkdownWithMath
+        self._IPythonRenderer = IPythonRenderer
+        self._strip_files_prefix = strip_files_prefix
+
+    def render(self, source, attachments=None):
+        """Render markdown cell source into HTML, see NbconvertRenderer.render()"""
+        renderer = self._IPythonRenderer(escape=False,
+                                         attachments=dict(attachments or {}),
+                                         anchor_link_text='¶')
+        html = self._MarkdownWithMath(renderer=renderer).render(source)
+        html = self._strip_files_prefix(html)
+        return _basic_prefix + html + _basic_suffix
+
+
+RENDERERS = {
+    'nbconvert': NbconvertRenderer,
+    'mistune': MistuneRenderer,
+}
+
+DEFAULT_RENDERER = 'mistune'
+
+_renderer_cache = {}
+
+
+def get_renderer(name=None):
+    """Get renderer by name, instances are created once and reused.
+
+    Params:
+        name (str or None): one of RENDERERS keys, None means DEFAULT_RENDERER
+
+    Returns:
+        NbconvertRenderer or MistuneRenderer: object with render() method
+    """
+    if name is None:
+        name = DEFAULT_RENDERER
+    if name not in RENDERERS:
+        raise ValueError(f'Unknown renderer: {name}, must be one of {list(RENDERERS)}')
+
+    if name not in _renderer_cache:
+        _renderer_cache[name] = RENDERERS[name]()
+    return _renderer_cache[name]
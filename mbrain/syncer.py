@@ -0,0 +1,194 @@
+"""Long-lived sync object with warm caches, for use inside Jupyter kernel.
+
+Example:
+    import mbrain as mb
+    syncer = mb.Syncer('/mnt/marcin-notes', 'Notes')
+    commands, orphaned_ids = syncer.prepare(['/mnt/marcin-notes/DeepRL_Notes.ipynb'])
+    syncer.execute(commands)
+
+See also mbrain.magic for %anki_sync IPython magic.
+"""
+
+import os
+import json
+import concurrent.futures
+
+from .jupyter import get_meta
+from .jupyter import remove_meta
+from .jupyter import is_flashcard
+from .jupyter import process_cell
+from .anki import anki_get_note
+from .anki import anki_find_notes
+from .anki import anki_bind_url
+from .convert import read_notebook
+from .convert import read_note_ids
+from .convert import read_notebook_filepaths
+from .convert import _exec_command
+from .convert import _update_tags
+from .convert import _write_notebooks
+from .convert import _validate_commands
+from .convert import _figure_out_command
+
+
+class Syncer:
+    """Keeps parsed notebooks, rendered cards and Anki deck state across syncs.
+
+    Caches:
+     - notebooks, keyed by path, re-read only if file modification time changed
+     - note IDs used by each notebook (for orphan check), same invalidation
+     - rendered cards, keyed by cell source (without meta) and attachments,
+       so unchanged cards are not rendered again
+     - deck snapshot (note IDs) and note contents fetched from Anki, updated
+       as commands are executed
+
+    Anki caches assume deck is changed only through this object. If notes
+    were edited or deleted in Anki directly, call refresh() first.
+
+    Note: notebooks are read from disk, so save notebook before syncing it.
+    New note IDs are written into .ipynb files, reload notebook in Jupyter
+    afterwards (File | Reload Notebook from Disk).
+
+    Attributes:
+        notes_folder_location (str): folder with .ipynb notes and anki_sync.txt
+        anki_deck_name (str): deck name in Anki database to sync to
+        renderer (str or None): markdown renderer backend, see process_cell()
+        num_workers (int): number of threads querying Anki for uncached notes
+    """
+    def __init__(self, notes_folder_location, anki_deck_name, renderer=None, num_workers=8):
+        assert isinstance(notes_folder_location, str)
+        assert isinstance(anki_deck_name, str)
+
+        self.notes_folder_location = os.path.abspath(notes_folder_location)
+        self.anki_deck_name = anki_deck_name
+        self.renderer = renderer
+        self.num_workers = num_workers
+
+        self._notebooks = {}     # path -> (mtime, notebook)
+        self._used_ids = {}      # path -> (mtime, set of note IDs in notebook)
+        self._cards = {}         # cell key -> (head, body, attachments)
+        self._note_ids = None    # set of note IDs in Anki deck, None if not fetched
+        self._notes = {}         # note ID -> (front, back) as stored in Anki
+
+    def refresh(self):
+        """Drop Anki caches, next prepare() will query Anki again."""
+        self._note_ids = None
+        self._notes = {}
+
+    def notebook_filepaths(self):
+        """All notebooks listed in anki_sync.txt"""
+        return read_notebook_filepaths(self.notes_folder_location)
+
+    def _get_notebook(self, filepath):
+        mtime = os.path.getmtime(filepath)
+        if filepath not in self._notebooks or self._notebooks[filepath][0] != mtime:
+            self._notebooks[filepath] = (mtime, read_notebook(filepath))
+        return self._notebooks[filepath][1]
+
+    def _get_used_ids(self, filepath):
+        """Note IDs in notebook meta, without parsing notebook if possible."""
+        mtime = os.path.getmtime(filepath)
+        if filepath not in self._used_ids or self._used_ids[filepath][0] != mtime:
+            if filepath in self._notebooks and self._notebooks[filepath][0] == mtime:
+                nb = self._notebooks[filepath][1]
+                ids = {get_meta(c.source).get('id') for c in nb['cells'] if is_flashcard(c)}
+                ids.discard(None)
+            else:
+                ids = read_note_ids(filepath)
+            self._used_ids[filepath] = (mtime, ids)
+        return self._used_ids[filepath][1]
+
+    def _process_cell(self, cell):
+        # Key without meta, so card is not rendered again after new ID is put in meta
+        key = (remove_meta(cell.source), json.dumps(cell.get('attachments', {}), sort_keys=True))
+        if key not in self._cards:
+            _, head, body, attachments = process_cell(cell, renderer=self.renderer)
+            self._cards[key] = (head, body, attachments)
+        head, body, attachments = self._cards[key]
+        return get_meta(cell.source), head, body, attachments
+
+    def _get_note_ids(self):
+        if self._note_ids is None:
+            note_ids = anki_find_notes(self.anki_deck_name)
+            assert len(note_ids) == len(set(note_ids))
+            self._note_ids = set(note_ids)
+        return self._note_ids
+
+    def _fetch_notes(self, note_ids):
+        """Fetch uncached notes from Anki in parallel."""
+        missing = [id_ for id_ in note_ids if id_ not in self._notes]
+        if len(missing) == 0:
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            for id_, note in zip(missing, executor.map(anki_bind_url(anki_get_note), missing)):
+                self._notes[id_] = note
+
+    def prepare(self, notebook_filepaths=None, validate=False):
+        """Prepare commands to sync, see commands_prepare()
+
+        Params:
+            notebook_filepaths (list-of-str or None): notebooks to sync,
+                None means all notebooks listed in anki_sync.txt
+            validate (bool): if True, pre-flight check new cards, see commands_prepare()
+
+        Returns:
+            commands (list-of-mbrain.Command): see commands_prepare()
+            orphaned_ids (set-of-str): note IDs in deck not used by any notebook
+                listed in anki_sync.txt
+        """
+        all_filepaths = self.notebook_filepaths()
+        if notebook_filepaths is None:
+            notebook_filepaths = all_filepaths
+
+        note_ids = self._get_note_ids()
+
+        cards = []   # (filepath, cell, meta, head, body, attachments)
+        for filepath in notebook_filepaths:
+            nb = self._get_notebook(filepath)
+            for cell in nb['cells']:
+                if not is_flashcard(cell):
+                    continue
+                meta, head, body, attachments = self._process_cell(cell)
+                cards.append((filepath, cell, meta, head, body, attachments))
+
+        self._fetch_notes([c[2]['id'] for c in cards if c[2].get('id') in note_ids])
+
+        commands = []
+        for filepath, cell, meta, head, body, attachments in cards:
+            cmd = _figure_out_command(meta, head, body, note_ids, self._notes.__getitem__,
+                                      deck=self.anki_deck_name, cell=cell,
+                                      attachments=attachments, filepath=filepath)
+            commands.append(cmd)
+
+        used_ids = {cmd.id for cmd in commands if cmd.id is not None}
+        for filepath in all_filepaths:
+            if filepath not in notebook_filepaths:
+                used_ids |= self._get_used_ids(filepath)
+        orphaned_ids = note_ids - used_ids
+
+        if validate:
+            _validate_commands(commands)
+
+        return commands, orphaned_ids
+
+    def execute(self, commands):
+        """Execute commands, write back changed notebooks and update caches.
+
+        Params:
+            commands (list-of-mbrain.Command): as from prepare()
+        """
+        note_ids = self._get_note_ids()   # may be dropped by refresh()
+        for cmd in commands:
+            if cmd.cmd == 'noop':
+                continue
+            print('Executing:', cmd.cmd, cmd.head)
+            _exec_command(cmd)
+
+            id_ = cmd.id if cmd.id is not None else get_meta(cmd.cell.source)['id']
+            note_ids.add(id_)
+            self._notes[id_] = (cmd.head, cmd.body)
+        _update_tags(commands)
+
+        changed = {cmd.notebook_filepath for cmd in commands if cmd.notebook_changed}
+        _write_notebooks({fp: self._notebooks[fp][1] for fp in changed}, commands)
+        for fp in changed:
+            self._notebooks[fp] = (os.path.getmtime(fp), self._notebooks[fp][1])
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+"""Micro-benchmarks for mbrain.jupyter text transforms.
+
+Each case runs one transform over generated input at several sizes
+(realistic cards and adversarial inputs: very long lines, many or unbalanced
+'$', huge inline base64 images, thousands of '**' markers) and records:
+ - best time per call
+ - peak memory allocated during one call (tracemalloc)
+ - scaling exponent, i.e. slope of log(time) vs log(size)
+
+Fails (exit code 1) if any case scales super-linearly, or if --compare is
+given and a case got slower than recorded baseline by more than --tolerance.
+
+Run from repo root:
+    python scripts/benchmark_jupyter.py
+    python scripts/benchmark_jupyter.py --save bench_baseline.json
+    python scripts/benchmark_jupyter.py --compare bench_baseline.json
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import base64
+import argparse
+import tracemalloc
+
+import nbformat
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from mbrain import jupyter
+
+
+# Realistic flashcard, as in notebooks/Example.ipynb
+CARD = ('<!--- {"id": "1609542455713"} --->\n\n'
+        '**Example question with $x = 2$ goes here**\n\n'
+        'Some good and clear answer goes here\n\n'
+        '* add some dollar signs <span>\\$</span>10 and <span>\\$</span>20 usd\n'
+        '* bullet with $x = 4$ math and $x = 5$ more math\n\n'
+        '$$ x = 2^4 $$\n\n')
+
+ATTACHMENT = '![image.png](attachment:image.png)'
+
+
+def _png_base64(n):
+    """Fake base64 payload of (roughly) n characters."""
+    return base64.b64encode(b'\x89PNG' * (n // 5 + 1)).decode()[:n]
+
+
+def _cell(source, n_attachments=0, payload=''):
+    attachments = {f'image{i}.png': {'image/png': payload} for i in range(n_attachments)}
+    return nbformat.from_dict({'cell_type': 'markdown', 'metadata': {},
+                               'source': source, 'attachments': attachments})
+
+
+def _img_html(name, payload):
+    return f'<img src="data:image/png;base64,{payload}" alt="{name}">'
+
+
+# Each case: name -> (function under test, input factory for size n, base size)
+# Input factory returns tuple of positional arguments for the function.
+CASES = {
+    # realistic, many cards concatenated
+    'get_meta/cards':               (jupyter.get_meta, lambda n: (CARD * n,), 100),
+    'put_meta/cards':               (jupyter.put_meta, lambda n: (CARD * n, '123'), 100),
+    'remove_meta/cards':            (jupyter.remove_meta, lambda n: (CARD * n,), 100),
+    'get_head/cards':               (jupyter.get_head, lambda n: (CARD * n,), 100),
+    'replace_double_dollars/cards': (jupyter.replace_double_dollars, lambda n: (CARD * n,), 100),
+    'replace_single_dollars/cards': (jupyter.replace_single_dollars, lambda n: (CARD * n,), 100),
+
+    # very long single line
+    'get_meta/long_line':           (jupyter.get_meta, lambda n: ('<!--- --->' + 'a' * n,), 10000),
+    'get_head/long_line':           (jupyter.get_head, lambda n: ('**q**' + 'a' * n,), 10000),
+    'replace_single_dollars/long_line':
+                                    (jupyter.replace_single_dollars, lambda n: ('$x$ ' + 'a' * n,), 10000),
+
+    # many or unbalanced $
+    'replace_single_dollars/many':  (jupyter.replace_single_dollars, lambda n: ('$x$ ' * n,), 1000),
+    'replace_single_dollars/unbalanced':
+                                    (jupyter.replace_single_dollars, lambda n: (('$ a ' + 'b ' * n + '\n') * 10,), 1000),
+    'replace_single_dollars/escaped':
+                                    (jupyter.replace_single_dollars, lambda n: ('<span>\\$</span>5 ' * n,), 1000),
+    'replace_double_dollars/many':  (jupyter.replace_double_dollars, lambda n: ('$$ x $$\n' * n,), 1000),
+    'replace_double_dollars/unbalanced':
+                                    (jupyter.replace_double_dollars, lambda n: (('$$ a ' + 'b ' * n + '\n') * 10,), 1000),
+
+    # thousands of ** markers
+    'get_head/many_markers':        (jupyter.get_head, lambda n: ('**a** ' * n,), 1000),
+    'get_head/unbalanced_markers':  (jupyter.get_head, lambda n: ('a ' * n + '**q**',), 1000),
+
+    # huge inline base64 images
+    'get_attachments/huge_image':   (jupyter.get_attachments,
+                                     lambda n: (_cell(ATTACHMENT.replace('image.png', 'image0.png'),
+                                                      1, _png_base64(n)),), 100000),
+    'get_attachments/many_images':  (jupyter.get_attachments,
+                                     lambda n: (_cell(''.join(ATTACHMENT.replace('image.png', f'image{i}.png')
+                                                              for i in range(n)), n, 'iVBORw0KGgo='),), 100),
+    'replace_image_tags/huge_image':
+                                    (jupyter.replace_image_tags,
+                                     lambda n: ('<p>' + _img_html('image.png', _png_base64(n)) + '</p>\n',
+                                                'image.png', 'a' * 64), 100000),
+    'replace_image_tags/many_lines':
+                                    (jupyter.replace_image_tags,
+                                     lambda n: (('<p>' + _img_html('image.png', 'iVBORw0KGgo=') + '</p>\n') * n,
+                                                'image.png', 'a' * 64), 100),
+}
+
+SCALES = [1, 2, 4, 8]
+
+
+def time_call(func, args, min_time=0.05, repeat=3):
+    """Best time per call in seconds."""
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            func(*args)
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_time:
+            break
+        number *= 2
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            func(*args)
+        best = min(best, (time.perf_counter() - t0) / number)
+    return best
+
+
+def peak_alloc(func, args):
+    """Peak memory in bytes allocated during single call."""
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def run_case(func, factory, base_size):
+    """Run single case at all SCALES.
+
+    Returns:
+        dict: {'sizes', 'seconds', 'peak_bytes', 'exponent'}
+    """
+    sizes, seconds, peaks = [], [], []
+    for scale in SCALES:
+        n = base_size * scale
+        args = factory(n)
+        sizes.append(n)
+        seconds.append(time_call(func, args))
+        peaks.append(peak_alloc(func, args))
+
+    # least squares slope of log(time) vs log(size)
+    xs = [math.log(s) for s in sizes]
+    ys = [math.log(t) for t in seconds]
+    x_mean, y_mean = sum(xs) / len(xs), sum(ys) / len(ys)
+    exponent = (sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys))
+                / sum((x - x_mean) ** 2 for x in xs))
+
+    return {'sizes': sizes, 'seconds': seconds, 'peak_bytes': peaks, 'exponent': exponent}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark mbrain.jupyter transforms.')
+    parser.add_argument('--filter', default='',
+                        help='Run only cases containing this substring')
+    parser.add_argument('--max-exponent', type=float, default=1.4,
+                        help='Fail if time grows faster than size**max_exponent')
+    parser.add_argument('--save', metavar='FILE',
+                        help='Save results as baseline JSON')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='Compare against baseline JSON')
+    parser.add_argument('--tolerance', type=float, default=2.0,
+                        help='Fail if slower than baseline by more than this factor')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+
+    results = {}
+    failed = []
+
+    print(f'{"case":<40} {"largest n":>10} {"time":>11} {"peak mem":>11} {"exp":>5}')
+    for name, (func, factory, base_size) in CASES.items():
+        if args.filter not in name:
+            continue
+
+        res = run_case(func, factory, base_size)
+        results[name] = res
+
+        status = ''
+        if res['exponent'] > args.max_exponent:
+            status = ' SUPER-LINEAR'
+            failed.append(name)
+        if name in baseline:
+            ratio = res['seconds'][-1] / baseline[name]['seconds'][-1]
+            status += f' {ratio:.2f}x baseline'
+            if ratio > args.tolerance:
+                status += ' REGRESSION'
+                failed.append(name)
+
+        print(f'{name:<40} {res["sizes"][-1]:>10} {res["seconds"][-1]*1e6:>9.1f}us '
+              f'{res["peak_bytes"][-1]/1024:>8.1f}KiB {res["exponent"]:>5.2f}{status}')
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print('Written:', args.save)
+
+    if len(failed) != 0:
+        print('FAIL:', ', '.join(sorted(set(failed))))
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""Import check for mbrain.export_apkg(), uses Anki's own importer.
+
+Creates Anki collection with user-made 'Basic-MathJax' model (copy of
+'Basic' with custom template), exports Example notebook with that model's
+ID (read via fake AnkiConnect, same as 'jupyanki.py export'), imports the
+package and checks that:
+ - no new model (e.g. 'Basic-MathJax+') was created
+ - all notes were imported under user's 'Basic-MathJax' model,
+   with same IDs as written to notebook
+ - user's templates were not overwritten
+ - importing same package again adds nothing
+
+Needs 'anki' Python package (pip install anki), skipped if not installed.
+
+Run from repo root:
+    python scripts/check_apkg.py
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import mbrain as mb
+from fake_anki_connect import FakeAnkiConnect
+
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+DEFAULT_NOTEBOOK = os.path.join(REPO_ROOT, 'notebooks', 'Example.ipynb')
+
+USER_QFMT = '{{Front}}<!-- user template -->'
+
+
+def create_collection(filepath):
+    """Collection with 'Basic-MathJax' model made by user, as README asks."""
+    from anki.collection import Collection
+
+    col = Collection(filepath)
+    model = col.models.copy(col.models.by_name('Basic'))
+    model['name'] = 'Basic-MathJax'
+    model['tmpls'][0]['qfmt'] = USER_QFMT
+    col.models.update_dict(model)
+    return col
+
+
+def import_apkg(col, apkg_filepath):
+    from anki.collection import ImportAnkiPackageRequest
+    from anki.import_export_pb2 import ImportAnkiPackageOptions
+
+    col.import_anki_package(ImportAnkiPackageRequest(
+        package_path=apkg_filepath, options=ImportAnkiPackageOptions()))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Check export_apkg() against Anki importer.')
+    parser.add_argument('--notebook', default=DEFAULT_NOTEBOOK,
+                        help='Notebook with flashcards, not modified')
+    args = parser.parse_args()
+
+    try:
+        import anki.collection
+    except ImportError:
+        print('SKIP: anki package not installed')
+        return
+
+    errors = []
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        notebook = os.path.join(tmp_dir, os.path.basename(args.notebook))
+        shutil.copy(args.notebook, notebook)
+        apkg = os.path.join(tmp_dir, 'out.apkg')
+
+        col = create_collection(os.path.join(tmp_dir, 'collection.anki2'))
+        model_id = col.models.id_for_name('Basic-MathJax')
+        models_before = sorted(m.name for m in col.models.all_names_and_ids())
+
+        fake = FakeAnkiConnect()
+        fake.models['Basic-MathJax'] = model_id
+        url = fake.start()
+        try:
+            with mb.anki_connect_url(url):
+                exported_model_id = mb.anki_model_id('Basic-MathJax')
+        finally:
+            fake.stop()
+        if exported_model_id != model_id:
+            errors.append(f'anki_model_id(): expected {model_id}, got {exported_model_id}')
+
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            commands = mb.export_apkg({notebook: mb.read_notebook(notebook)}, 'Testing',
+                                      apkg, exported_model_id)
+        import_apkg(col, apkg)
+
+        models_after = sorted(m.name for m in col.models.all_names_and_ids())
+        if models_after != models_before:
+            errors.append(f'new models created on import: {set(models_after) - set(models_before)}')
+
+        note_ids = sorted(col.find_notes('deck:Testing'))
+        expected_ids = sorted(int(cmd.id) for cmd in commands)
+        if note_ids != expected_ids:
+            errors.append(f'imported note IDs {note_ids}, expected {expected_ids}')
+        for nid in note_ids:
+            name = col.get_note(nid).note_type()['name']
+            if name != 'Basic-MathJax':
+                errors.append(f'note {nid} imported under model {name!r}')
+
+        qfmt = col.models.by_name('Basic-MathJax')['tmpls'][0]['qfmt']
+        if qfmt != USER_QFMT:
+            errors.append(f'user template overwritten on import: {qfmt[:40]!r}')
+
+        import_apkg(col, apkg)
+        if len(col.find_notes('')) != len(note_ids):
+            errors.append('second import added notes')
+        col.close()
+
+    for error in errors:
+        print('FAIL:', error)
+    print(f'{len(commands)} notes imported')
+
+    if len(errors) != 0:
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
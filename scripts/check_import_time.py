@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+"""Import-time regression check for mbrain.
+
+Imports mbrain in a fresh interpreter (so nothing is cached), touches the
+Anki-only API and makes sure none of the heavy rendering dependencies got
+pulled in, and that import stays under the time budget.
+
+Run from repo root:
+    python scripts/check_import_time.py
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+
+# These must only be imported when rendering actually happens
+HEAVY_MODULES = ['nbformat', 'nbconvert', 'jinja2', 'mistune', 'bleach', 'pygments', 'traitlets']
+
+# Child process imports mbrain, touches Anki-only API, reports back
+CHILD_CODE = '''
+import sys, json, time
+t0 = time.perf_counter()
+import mbrain as mb
+mb.anki_invoke, mb.anki_find_notes, mb.anki_get_note
+t1 = time.perf_counter()
+print(json.dumps({'seconds': t1 - t0, 'modules': sorted(sys.modules)}))
+'''
+
+
+def measure(repeat):
+    """Import mbrain in fresh interpreter 'repeat' times.
+
+    Returns:
+        seconds (float): best import time across runs
+        modules (set-of-str): modules loaded after import
+    """
+    repo_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = repo_root + os.pathsep + env.get('PYTHONPATH', '')
+
+    best_seconds, modules = None, None
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', CHILD_CODE], env=env)
+        res = json.loads(out)
+        if best_seconds is None or res['seconds'] < best_seconds:
+            best_seconds = res['seconds']
+        modules = set(res['modules'])
+    return best_seconds, modules
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Check mbrain import time.')
+    parser.add_argument('--budget', type=float, default=0.1,
+                        help='Max allowed import time in seconds')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of fresh interpreter runs, best is used')
+    args = parser.parse_args()
+
+    seconds, modules = measure(args.repeat)
+
+    print(f'Import time: {seconds*1000:.1f} ms (budget {args.budget*1000:.1f} ms)')
+
+    failed = False
+
+    eager = [m for m in HEAVY_MODULES if m in modules]
+    if len(eager) != 0:
+        print('FAIL: heavy modules imported eagerly:', ', '.join(eager))
+        failed = True
+
+    if seconds > args.budget:
+        print('FAIL: import time over budget')
+        failed = True
+
+    if failed:
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
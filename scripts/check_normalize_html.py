@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+"""Checks for mbrain.normalize_html(), which decides noop vs update in sync.
+
+Checks that:
+ - normalize_html() is idempotent, on hand-written cases and Example cards
+ - whitespace inside <pre> is preserved, elsewhere collapsed
+ - entities (incl. &nbsp;) are decoded and re-escaped consistently
+ - Example cards come back as 'noop' after Anki-style html rewrite,
+   and as 'update' if content really changed
+
+Does not need Anki, note fields are faked.
+
+Run from repo root:
+    python scripts/check_normalize_html.py
+"""
+
+import os
+import re
+import sys
+import argparse
+
+import nbformat
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import mbrain as mb
+from mbrain.convert import _figure_out_command
+
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+DEFAULT_NOTEBOOK = os.path.join(REPO_ROOT, 'notebooks', 'Example.ipynb')
+
+# (html, expected normalize_html(html))
+EXPECTED = [
+    ('<p> a  b </p>', '<p>a b</p>'),
+    ('<P CLASS="x  y" ID=z>a</P>', '<p class="x y" id="z">a</p>'),
+    ('<div style="text-align:left;">a</div>', '<div style="text-align: left">a</div>'),
+    ('<div>\n  <p>a</p>\n</div>', '<div><p>a</p></div>'),
+    ('a <b>x</b> c', 'a <b>x</b> c'),
+    ('a<!-- comment -->b', 'ab'),
+    ('a <!-- comment --> b', 'a b'),
+    ('<br/><br />', '<br><br>'),
+    ('&lt;x&gt; &amp;lt; &#39; &quot;', '&lt;x&gt; &amp;lt; \' "'),
+    ('<a title="&quot;q&quot; &amp; b">x</a>', '<a title="&quot;q&quot; &amp; b">x</a>'),
+    ('<pre>a\n  b  c\n</pre>', '<pre>a\n  b  c\n</pre>'),
+    ('<div> <pre> x </pre> </div>', '<div><pre> x </pre></div>'),
+    ('<script>if (a < b && c) {}</script>', '<script>if (a < b && c) {}</script>'),
+]
+
+# pairs which must normalize to same string
+SAME = [
+    ('a&nbsp;b', 'a\xa0b'),
+    ('&#x27;', "'"),
+    ('<img src="x" alt="y">', '<img alt="y" src="x" />'),
+    ('<p>a</p>\n<p>b</p>', '<p>a</p><p>b</p>'),
+]
+
+# pairs which must normalize to different strings
+DIFFERENT = [
+    ('a&nbsp;b', 'a b'),                       # nbsp is not collapsible whitespace
+    ('<pre>a  b</pre>', '<pre>a b</pre>'),     # whitespace inside <pre> matters
+    ('a <b>x</b>', 'a<b>x</b>'),               # space before inline tag matters
+    ('&lt;b&gt;', '<b>'),                      # escaped text is not a tag
+]
+
+
+def anki_rewrite(html):
+    """Mimic how Anki and its editor rewrite stored html fields."""
+    # leave <pre> content alone, rewrite everything else
+    parts = re.split(r'(<pre[^>]*>.*?</pre>)', html, flags=re.DOTALL)
+    for i in range(0, len(parts), 2):
+        s = parts[i]
+        s = s.replace('style="text-align: left"', 'style="text-align:left;"')
+        s = re.sub(r'<(\w+) class="([^"]*)" style="([^"]*)">', r'<\1 style="\3" class="\2">', s)
+        s = s.replace('><', '>\n<')
+        s = s.replace('<br>', '<br />')
+        s = s.replace("'", '&#x27;').replace('\xa0', '&nbsp;')
+        parts[i] = s
+    return ''.join(parts)
+
+
+def read_cards(notebook_filepath):
+    with open(notebook_filepath, 'r') as f:
+        nb = nbformat.read(f, as_version=4)
+    return [mb.process_cell(cell) for cell in nb['cells'] if mb.is_flashcard(cell)]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Check normalize_html().')
+    parser.add_argument('--notebook', default=DEFAULT_NOTEBOOK,
+                        help='Notebook with flashcards')
+    args = parser.parse_args()
+
+    errors = []
+    norm = mb.normalize_html
+
+    for html, expected in EXPECTED:
+        if norm(html) != expected:
+            errors.append(f'{html!r}: got {norm(html)!r}, expected {expected!r}')
+
+    for a, b in SAME:
+        if norm(a) != norm(b):
+            errors.append(f'{a!r} and {b!r} should normalize the same: {norm(a)!r} {norm(b)!r}')
+
+    for a, b in DIFFERENT:
+        if norm(a) == norm(b):
+            errors.append(f'{a!r} and {b!r} should normalize differently: {norm(a)!r}')
+
+    cards = read_cards(args.notebook)
+    samples = [html for pair in EXPECTED + SAME + DIFFERENT for html in pair]
+    samples += [html for _, head, body, _ in cards for html in (head, body, anki_rewrite(body))]
+    for html in samples:
+        if norm(norm(html)) != norm(html):
+            errors.append(f'not idempotent: {html[:80]!r}')
+
+    for _, head, body, _ in cards:
+        stored = (anki_rewrite(head), anki_rewrite(body))
+        cmd = _figure_out_command({'id': '1'}, head, body, {'1'}, lambda id_: stored)
+        if cmd.cmd != 'noop':
+            errors.append(f'{head}: expected noop after Anki rewrite, got {cmd.cmd}')
+
+        stored = (head, body.replace('</p>', ' changed</p>', 1))
+        cmd = _figure_out_command({'id': '1'}, head, body, {'1'}, lambda id_: stored)
+        if cmd.cmd != 'update':
+            errors.append(f'{head}: expected update after edit, got {cmd.cmd}')
+
+    for error in errors:
+        print('FAIL:', error)
+    print(f'{len(EXPECTED) + len(SAME) + len(DIFFERENT)} cases, {len(cards)} cards checked')
+
+    if len(errors) != 0:
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
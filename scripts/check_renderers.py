@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+"""Golden-file equivalence check for mbrain.render backends.
+
+Processes every flashcard in given notebooks with each renderer backend
+and checks that:
+ - all backends produce exactly the same (meta, head, body)
+ - output matches golden file recorded with reference 'nbconvert' backend
+
+Run from repo root:
+    python scripts/check_renderers.py
+    python scripts/check_renderers.py --update   # re-record golden file
+"""
+
+import os
+import sys
+import json
+import argparse
+
+import nbformat
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import mbrain as mb
+from mbrain.render import RENDERERS
+
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+DEFAULT_NOTEBOOK = os.path.join(REPO_ROOT, 'notebooks', 'Example.ipynb')
+DEFAULT_GOLDEN = os.path.join(REPO_ROOT, 'notebooks', 'Example_golden.json')
+
+
+def render_cards(notebook_filepath, renderer):
+    """Process all flashcards in notebook.
+
+    Returns:
+        list-of-dict: one {'meta', 'head', 'body'} per flashcard, in cell order
+    """
+    with open(notebook_filepath, 'r') as f:
+        nb = nbformat.read(f, as_version=4)
+
+    cards = []
+    for cell in nb['cells']:
+        if not mb.is_flashcard(cell):
+            continue
+        meta, head, body, _ = mb.process_cell(cell, renderer=renderer)
+        cards.append({'meta': meta, 'head': head, 'body': body})
+    return cards
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Check renderer backends are equivalent.')
+    parser.add_argument('--notebook', default=DEFAULT_NOTEBOOK,
+                        help='Notebook with flashcards to render')
+    parser.add_argument('--golden', default=DEFAULT_GOLDEN,
+                        help='Golden file with reference output')
+    parser.add_argument('--update', action='store_true',
+                        help='Re-record golden file with reference backend')
+    args = parser.parse_args()
+
+    reference = render_cards(args.notebook, 'nbconvert')
+
+    if args.update:
+        with open(args.golden, 'w') as f:
+            json.dump(reference, f, indent=1, sort_keys=True)
+            f.write('\n')
+        print('Written:', args.golden)
+
+    with open(args.golden, 'r') as f:
+        golden = json.load(f)
+
+    failed = False
+    for name in RENDERERS:
+        cards = render_cards(args.notebook, name)
+        if len(cards) != len(golden):
+            print(f'FAIL: {name}: {len(cards)} cards, golden has {len(golden)}')
+            failed = True
+            continue
+        for card, gold in zip(cards, golden):
+            if card != gold:
+                print(f'FAIL: {name}: {card["head"]}')
+                for key in ['meta', 'head', 'body']:
+                    if card[key] != gold[key]:
+                        print(f'  {key} got:      {card[key]!r}')
+                        print(f'  {key} expected: {gold[key]!r}')
+                failed = True
+        print(f'{name}: {len(cards)} cards checked')
+
+    if failed:
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
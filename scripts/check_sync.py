@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+"""End-to-end sync checks against in-memory fake AnkiConnect.
+
+Checks that:
+ - card whose note ID lives in other deck is planned as 'add2',
+   in full and in scoped (--since) mode
+ - scoped mode checks all untagged note IDs in single request
+ - notes are tagged with their notebook, moved cards are retagged
+ - orphaned notes keep their tag and are still reported in scoped mode
+ - '_' in notebook tag is not a search wildcard, e.g. 'A B' vs 'AxB'
+ - stream: notebook is pre-flight checked before any of its cards is sent,
+   and IDs of notes added before a failing card are written back
+ - outbox: unchanged cards are not queued twice, media are stored
+ - outbox: flush never overwrites newer content synced online since queued,
+   with or without outbox_drop() after online sync
+
+Does not need Anki, see scripts/fake_anki_connect.py
+
+Run from repo root:
+    python scripts/check_sync.py
+"""
+
+import os
+import sys
+import tempfile
+import contextlib
+
+import nbformat
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import mbrain as mb
+from fake_anki_connect import FakeAnkiConnect
+
+
+DECK = 'Testing'
+
+errors = []
+
+
+def check(condition, message):
+    if not condition:
+        errors.append(message)
+
+
+def card_source(question, answer, id_=None):
+    meta = '<!--- --->' if id_ is None else '<!--- {"id": "%s"} --->' % id_
+    return f'{meta}\n\n**{question}**\n\n{answer}'
+
+
+def write_notebook(filepath, sources, attachments=None):
+    nb = nbformat.v4.new_notebook()
+    nb['cells'] = [nbformat.v4.new_markdown_cell(s) for s in sources]
+    if attachments is not None:
+        nb['cells'][0]['attachments'] = attachments
+    with open(filepath, 'w') as f:
+        nbformat.write(nb, f)
+
+
+def note_ids_of(filepath):
+    nb = mb.read_notebook(filepath)
+    return [mb.get_meta(c.source).get('id') for c in nb['cells'] if mb.is_flashcard(c)]
+
+
+def sync(filepaths, other_note_ids=None):
+    """Same as 'jupyanki.py sync', returns (commands, orphaned_ids)"""
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        file_nb_dict, commands, orphaned_ids = mb.commands_prepare_pipelined(
+            filepaths, DECK, other_note_ids=other_note_ids,
+            scope_by_tag=other_note_ids is not None)
+        mb.commands_execute(file_nb_dict, commands)
+    return commands, orphaned_ids
+
+
+def check_other_deck(fake, folder):
+    """Note ID from other deck must not be updated, but re-added to this one."""
+    other_id = fake.add('Other', '<p><strong>Q</strong></p>', '<p>A</p>')
+    for scoped in [False, True]:
+        fp = os.path.join(folder, f'OtherDeck{int(scoped)}.ipynb')
+        write_notebook(fp, [card_source('Q', 'A', other_id)])
+        other_note_ids = set() if scoped else None
+        _, commands, _ = mb.commands_prepare_pipelined(
+            [fp], DECK, other_note_ids=other_note_ids, scope_by_tag=scoped)
+        cmds = [cmd.cmd for cmd in commands]
+        check(cmds == ['add2'], f'other deck, scoped={scoped}: expected add2, got {cmds}')
+
+
+def check_single_existence_request(fake, folder):
+    """Untagged notes (synced before tags) are checked in one request."""
+    fp = os.path.join(folder, 'Untagged.ipynb')
+    sources = []
+    for i in range(5):
+        _, head, body, _ = mb.process_cell(nbformat.v4.new_markdown_cell(card_source(f'U{i}', 'x')))
+        sources.append(card_source(f'U{i}', 'x', fake.add(DECK, head, body)))
+    write_notebook(fp, sources)
+
+    fake.calls.clear()
+    _, commands, orphaned_ids = mb.commands_prepare_pipelined(
+        [fp], DECK, other_note_ids=set(), scope_by_tag=True)
+    cmds = [cmd.cmd for cmd in commands]
+    check(cmds == ['noop'] * 5, f'untagged: expected 5 noop, got {cmds}')
+    check(fake.count('findNotes') == 2,
+          f'untagged: expected 2 findNotes (tags, existence), got {fake.count("findNotes")}')
+    check(orphaned_ids == set(), f'untagged: unexpected orphans {orphaned_ids}')
+
+
+def check_tags(fake, folder):
+    """Tags follow cards between notebooks, orphans keep theirs."""
+    fp_a = os.path.join(folder, 'A.ipynb')
+    fp_b = os.path.join(folder, 'B.ipynb')
+    tag_a, tag_b = mb.notebook_tag(fp_a), mb.notebook_tag(fp_b)
+    write_notebook(fp_a, [card_source('A1', 'x'), card_source('A2', 'x'), card_source('A3', 'x')])
+    write_notebook(fp_b, [card_source('B1', 'x')])
+
+    sync([fp_a, fp_b])
+    a1, a2, a3 = note_ids_of(fp_a)
+    b1, = note_ids_of(fp_b)
+    for id_, tag in [(a1, tag_a), (a2, tag_a), (a3, tag_a), (b1, tag_b)]:
+        check(fake.notes[int(id_)]['tags'] == [tag], f'{id_}: expected [{tag}], got '
+              f'{fake.notes[int(id_)]["tags"]}')
+
+    # move A2 to B, delete A3
+    nb = mb.read_notebook(fp_a)
+    cells = nb['cells']
+    write_notebook(fp_a, [cells[0].source])
+    write_notebook(fp_b, [card_source('B1', 'x', b1), cells[1].source])
+
+    commands, orphaned_ids = sync([fp_a, fp_b], other_note_ids=set())
+    cmds = sorted(cmd.cmd for cmd in commands)
+    check(cmds == ['noop'] * 3, f'moved: expected 3 noop, got {cmds}')
+    check(orphaned_ids == {a3}, f'moved: expected orphans {{{a3}}}, got {orphaned_ids}')
+    check(fake.notes[int(a2)]['tags'] == [tag_b], f'moved: expected [{tag_b}], got '
+          f'{fake.notes[int(a2)]["tags"]}')
+    check(fake.notes[int(a3)]['tags'] == [tag_a], f'orphan: expected [{tag_a}], got '
+          f'{fake.notes[int(a3)]["tags"]}')
+
+    # orphan still reported by next scoped sync of A only
+    _, orphaned_ids = sync([fp_a], other_note_ids=set(note_ids_of(fp_b)))
+    check(orphaned_ids == {a3}, f'scoped: expected orphans {{{a3}}}, got {orphaned_ids}')
+
+
+def check_stream(fake, folder):
+    """Duplicate front after a good new card, with and without validation."""
+    fp = os.path.join(folder, 'Stream.ipynb')
+    _, head, body, _ = mb.process_cell(nbformat.v4.new_markdown_cell(card_source('Dup', 'x')))
+    fake.add(DECK, head, body)
+
+    write_notebook(fp, [card_source('Good', 'x'), card_source('Dup', 'y')])
+    num_notes = len(fake.notes)
+    try:
+        quiet(mb.commands_stream, [fp], DECK)
+        check(False, 'stream: duplicate front not rejected by pre-flight check')
+    except ValueError:
+        pass
+    check(len(fake.notes) == num_notes, 'stream: notes added despite rejected pre-flight check')
+
+    try:
+        quiet(mb.commands_stream, [fp], DECK, validate=False)
+        check(False, 'stream: expected addNote of duplicate front to fail')
+    except Exception:
+        pass
+    good_id, dup_id = note_ids_of(fp)
+    check(good_id is not None and int(good_id) in fake.notes,
+          f'stream: ID of added note not written back, got {good_id}')
+    check(dup_id is None, f'stream: unexpected ID of rejected card {dup_id}')
+
+
+def check_tag_wildcards(fake, folder):
+    """Card moved from 'AxB' to 'A B' (tag mbrain::A_B) is retagged."""
+    fp_ab = os.path.join(folder, 'A B.ipynb')
+    fp_axb = os.path.join(folder, 'AxB.ipynb')
+    tag_ab, tag_axb = mb.notebook_tag(fp_ab), mb.notebook_tag(fp_axb)
+    write_notebook(fp_ab, [card_source('W1', 'x')])
+    write_notebook(fp_axb, [card_source('W2', 'x'), card_source('W3', 'x')])
+    sync([fp_ab, fp_axb])
+    w1, = note_ids_of(fp_ab)
+    w2, w3 = note_ids_of(fp_axb)
+
+    # scoped sync of 'A B' alone must not see notes of 'AxB'
+    _, orphaned_ids = sync([fp_ab], other_note_ids=set())
+    check(orphaned_ids == set(), f'wildcard: unexpected orphans {orphaned_ids}')
+
+    write_notebook(fp_ab, [card_source('W1', 'x', w1), card_source('W2', 'x', w2)])
+    write_notebook(fp_axb, [card_source('W3', 'x', w3)])
+    sync([fp_ab, fp_axb], other_note_ids=set())
+    for id_, tag in [(w1, tag_ab), (w2, tag_ab), (w3, tag_axb)]:
+        check(fake.notes[int(id_)]['tags'] == [tag], f'wildcard: {id_} expected [{tag}], '
+              f'got {fake.notes[int(id_)]["tags"]}')
+
+
+def quiet(fn, *args, **kwargs):
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        return fn(*args, **kwargs)
+
+
+def set_answer(filepath, answer):
+    """Edit answer of first card in notebook, keep its meta"""
+    nb = mb.read_notebook(filepath)
+    meta = mb.get_meta(nb['cells'][0].source)
+    write_notebook(filepath, [card_source('Q', answer, meta.get('id'))])
+
+
+def anki_back(fake, note_id):
+    return fake.notes[int(note_id)]['back']
+
+
+def check_outbox(fake, folder):
+    """Dedup and media, then v2 queued, v3 synced online, flush keeps v3."""
+    outbox = os.path.join(folder, 'outbox.sqlite')
+    fp = os.path.join(folder, 'Outbox.ipynb')
+    file_nb = lambda: {fp: mb.read_notebook(fp)}
+
+    # new card with image, queued twice, flushed, queued again
+    image = {'image.png': {'image/png': 'iVBORw0KGgo='}}
+    write_notebook(fp, [card_source('Q', 'v1 ![image.png](attachment:image.png)')], image)
+    _, num_queued = quiet(mb.outbox_queue, outbox, file_nb(), DECK)
+    check(num_queued == 1, f'outbox: expected 1 queued, got {num_queued}')
+    _, num_queued = quiet(mb.outbox_queue, outbox, file_nb(), DECK)
+    check(num_queued == 0, f'outbox: expected 0 queued again, got {num_queued}')
+
+    commands = quiet(mb.outbox_flush, outbox)
+    cmds = [(cmd.cmd, cmd.error) for cmd in commands]
+    check(cmds == [('add', None)], f'outbox: expected add, got {cmds}')
+    note_id, = note_ids_of(fp)
+    check(note_id is not None, 'outbox: note ID not written back')
+    check(len(fake.media) == 1, f'outbox: expected 1 media stored, got {list(fake.media)}')
+    _, num_queued = quiet(mb.outbox_queue, outbox, file_nb(), DECK)
+    check(num_queued == 0, f'outbox: expected 0 queued after flush, got {num_queued}')
+
+    for drop in [True, False]:
+        set_answer(fp, 'v2')
+        quiet(mb.outbox_queue, outbox, file_nb(), DECK)
+        set_answer(fp, 'v3')
+        sync([fp])
+        if drop:
+            quiet(mb.outbox_drop, outbox, [fp])
+            check(mb.outbox_pending(outbox) == [], f'outbox: not dropped after online sync')
+        commands = quiet(mb.outbox_flush, outbox)
+        check('v3' in anki_back(fake, note_id),
+              f'outbox, drop={drop}: flush overwrote newer content: {anki_back(fake, note_id)}')
+        check(all(cmd.cmd == 'noop' or cmd.error is not None for cmd in commands),
+              f'outbox, drop={drop}: unexpected {[(c.cmd, c.error) for c in commands]}')
+        check(mb.outbox_pending(outbox) == [], f'outbox, drop={drop}: stale card left queued')
+
+    # queued v4 not synced online in between is sent as usual
+    set_answer(fp, 'v4')
+    quiet(mb.outbox_queue, outbox, file_nb(), DECK)
+    commands = quiet(mb.outbox_flush, outbox)
+    cmds = [(cmd.cmd, cmd.error) for cmd in commands]
+    check(cmds == [('update', None)], f'outbox: expected update, got {cmds}')
+    check('v4' in anki_back(fake, note_id), f'outbox: expected v4, got {anki_back(fake, note_id)}')
+
+
+def main():
+
+    fake = FakeAnkiConnect(decks=['Default', DECK, 'Other'])
+    url = fake.start()
+
+    try:
+        with tempfile.TemporaryDirectory() as folder, mb.anki_connect_url(url):
+            check_other_deck(fake, folder)
+            check_single_existence_request(fake, folder)
+            check_tags(fake, folder)
+            check_tag_wildcards(fake, folder)
+            check_stream(fake, folder)
+            check_outbox(fake, folder)
+    finally:
+        fake.stop()
+
+    for error in errors:
+        print('FAIL:', error)
+
+    if len(errors) != 0:
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+"""Minimal in-memory AnkiConnect server, for checks and manual testing.
+
+Implements subset of AnkiConnect API (version 6) used by mbrain. Search
+queries support only what mbrain sends:
+    deck:"Name"  nid:1,2,3  tag:"a"  (tag:"a" OR tag:"b")
+several tag: terms are OR-ed. Like in Anki, deck and tag names are matched
+case-insensitively, include children ('a' matches 'a::b'), and unescaped
+'_' and '*' are wildcards for single character and any sequence.
+
+Use from check script:
+    server = FakeAnkiConnect(decks=['Default', 'Testing'])
+    url = server.start()     # background thread, free port
+    with mb.anki_connect_url(url):
+        ...
+    server.stop()
+
+Or run standalone and point ANKI_CONNECT_URL to it:
+    python scripts/fake_anki_connect.py 8765
+"""
+
+import re
+import sys
+import json
+import itertools
+import threading
+import http.server
+
+
+class FakeAnkiConnect:
+    """In-memory Anki collection behind AnkiConnect-like HTTP API.
+
+    Attributes:
+        decks (list-of-str): existing deck names
+        models (dict str->int): model name -> model ID
+        notes (dict int->dict): note ID -> {'deck', 'front', 'back', 'tags'}
+        media (dict str->str): media filename -> base64 data
+        calls (list-of-str): actions received, 'multi' sub-actions included
+    """
+    def __init__(self, decks=('Default',)):
+        self.decks = list(decks)
+        self.models = {'Basic': 1600000000001, 'Basic-MathJax': 1600000000002}
+        self.notes = {}
+        self.media = {}
+        self.calls = []
+        self._ids = itertools.count(1600000000000)
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self, port=0):
+        """Serve in background thread, returns endpoint url."""
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                try:
+                    with fake._lock:
+                        result = fake.handle(request['action'], request.get('params', {}))
+                    response = {'result': result, 'error': None}
+                except Exception as e:
+                    response = {'result': None, 'error': str(e)}
+                data = json.dumps(response).encode('utf-8')
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._server = http.server.ThreadingHTTPServer(('localhost', port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f'http://localhost:{self._server.server_address[1]}'
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def count(self, action):
+        """Number of times action was called."""
+        return self.calls.count(action)
+
+    def add(self, deck, front, back, tags=()):
+        """Add note directly, returns note ID as string."""
+        id_ = next(self._ids)
+        self.notes[id_] = {'deck': deck, 'front': front, 'back': back, 'tags': list(tags)}
+        return str(id_)
+
+    @staticmethod
+    def _pattern(text):
+        """Regex for Anki deck or tag search term, see module docstring."""
+        regex = ''
+        for escaped, char in re.findall(r'(\\?)(.)', text):
+            if escaped or char not in '_*':
+                regex += re.escape(char)
+            else:
+                regex += '.' if char == '_' else '.*'
+        return re.compile(regex + '(::.*)?', re.IGNORECASE | re.DOTALL)
+
+    def _find(self, query):
+        quoted = r'"((?:\\.|[^"\\])*)"'
+        deck = re.search(r'deck:' + quoted, query)
+        deck = None if deck is None else self._pattern(deck.group(1))
+        nids = re.search(r'nid:([\d,]+)', query)
+        tags = [self._pattern(t) for t in re.findall(r'tag:' + quoted, query)]
+        res = []
+        for id_, note in self.notes.items():
+            if deck and not deck.fullmatch(note['deck']):
+                continue
+            if nids and str(id_) not in nids.group(1).split(','):
+                continue
+            if tags and not any(p.fullmatch(t) for p in tags for t in note['tags']):
+                continue
+            res.append(id_)
+        return res
+
+    def _can_add(self, note):
+        front = note['fields']['Front']
+        if front.strip() == '':
+            return 'cannot create note because it is empty'
+        for other in self.notes.values():
+            if other['deck'] == note['deckName'] and other['front'] == front:
+                return 'cannot create note because it is a duplicate'
+        return None
+
+    def handle(self, action, params):
+        self.calls.append(action)
+        p = params
+
+        if action == 'deckNames':
+            return list(self.decks)
+        if action == 'modelNames':
+            return list(self.models)
+        if action == 'modelNamesAndIds':
+            return dict(self.models)
+        if action == 'modelFieldNames':
+            return ['Front', 'Back']
+        if action == 'findNotes':
+            return self._find(p['query'])
+        if action == 'notesInfo':
+            out = []
+            for id_ in p['notes']:
+                note = self.notes.get(int(id_))
+                if note is None:
+                    out.append({})
+                    continue
+                out.append({'noteId': int(id_), 'modelName': 'Basic-MathJax',
+                            'tags': list(note['tags']),
+                            'fields': {'Front': {'value': note['front'], 'order': 0},
+                                       'Back': {'value': note['back'], 'order': 1}}})
+            return out
+        if action == 'addNote':
+            note = p['note']
+            if note['deckName'] not in self.decks:
+                raise Exception('deck was not found: ' + note['deckName'])
+            error = self._can_add(note)
+            if error is not None:
+                raise Exception(error)
+            return int(self.add(note['deckName'], note['fields']['Front'],
+                                note['fields']['Back'], note.get('tags', [])))
+        if action == 'canAddNotes':
+            return [self._can_add(note) is None for note in p['notes']]
+        if action == 'canAddNotesWithErrorDetail':
+            out = []
+            for note in p['notes']:
+                error = self._can_add(note)
+                out.append({'canAdd': True} if error is None else {'canAdd': False, 'error': error})
+            return out
+        if action == 'updateNoteFields':
+            note = self.notes[int(p['note']['id'])]
+            fields = p['note']['fields']
+            note['front'] = fields.get('Front', note['front'])
+            note['back'] = fields.get('Back', note['back'])
+            return None
+        if action == 'deleteNotes':
+            for id_ in p['notes']:
+                self.notes.pop(int(id_), None)
+            return None
+        if action == 'addTags':
+            for id_ in p['notes']:
+                for tag in p['tags'].split():
+                    if tag not in self.notes[int(id_)]['tags']:
+                        self.notes[int(id_)]['tags'].append(tag)
+            return None
+        if action == 'removeTags':
+            for id_ in p['notes']:
+                for tag in p['tags'].split():
+                    if tag in self.notes[int(id_)]['tags']:
+                        self.notes[int(id_)]['tags'].remove(tag)
+            return None
+        if action == 'storeMediaFile':
+            self.media[p['filename']] = p['data']
+            return p['filename']
+        if action == 'retrieveMediaFile':
+            return self.media.get(p['filename'], False)
+        if action == 'multi':
+            out = []
+            for sub in p['actions']:
+                try:
+                    out.append({'result': self.handle(sub['action'], sub.get('params', {})),
+                                'error': None})
+                except Exception as e:
+                    out.append({'result': None, 'error': str(e)})
+            return out
+        raise Exception('unsupported action: ' + action)
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    server = FakeAnkiConnect(decks=['Default', 'Testing'])
+    print('Serving on', server.start(port))
+    threading.Event().wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,14 +3,48 @@
 import os
 import sys
 import argparse
+import urllib.error
 
 import mbrain as mb
 
-def sync(notes_folder_location, anki_deck_name, debug=False):
+def sync(notes_folder_location, anki_deck_name, debug=False, renderer=None, validate=True,
+         workers=8, since=None, full=False, outbox_filepath=None):
     
-    file_nb_dict = mb.read_notebooks(notes_folder_location)
+    notebook_filepaths = mb.read_notebook_filepaths(notes_folder_location)
+    
+    # Notes are tagged by notebook name, see mb.notebook_tag()
+    tags = [mb.notebook_tag(fp) for fp in notebook_filepaths]
+    if len(set(tags)) != len(tags):
+        print('Notebooks in anki_sync.txt must have unique names, duplicate tags:',
+              sorted({t for t in tags if tags.count(t) > 1}))
+        return
+    
+    # Git-aware selection: only sync notebooks changed since last synced commit
+    head = None
+    other_note_ids = None
+    if mb.git_is_repo(notes_folder_location):
+        head = mb.git_head(notes_folder_location)
+        if since is None and not full:
+            since = mb.read_last_synced(notes_folder_location, anki_deck_name)
+            if since is not None and not mb.git_is_commit(notes_folder_location, since):
+                print('Warning: last synced commit ' + since + ' no longer exists '
+                      '(rebase or force-push?), syncing all notebooks.')
+                since = None
+        if since is not None and not full:
+            notebook_filepaths, unchanged = mb.select_changed_notebooks(
+                notes_folder_location, notebook_filepaths, since)
+            print('Changed since ' + since + ':', len(notebook_filepaths), 'notebooks,',
+                  len(unchanged), 'unchanged skipped')
+            other_note_ids = set()
+            for fp in unchanged:
+                other_note_ids |= mb.read_note_ids(fp)
+    elif since is not None:
+        print('Warning: --since ignored, notes folder is not in git repo.')
     
-    commands, orphan_ids = mb.commands_prepare(file_nb_dict, anki_deck_name, dbg_print=debug)
+    file_nb_dict, commands, orphan_ids = mb.commands_prepare_pipelined(
+        notebook_filepaths, anki_deck_name, dbg_print=debug, renderer=renderer,
+        validate=validate, num_workers=workers, other_note_ids=other_note_ids,
+        scope_by_tag=other_note_ids is not None)
     
     print('Num orphaned cards in Anki:', len(orphan_ids))
     print('Num cards in Jupyter:', len(commands))
@@ -30,26 +64,216 @@ def sync(notes_folder_location, anki_deck_name, debug=False):
     print('Files that will be potentially updated:')
     for f in files_to_update:
         print(' + ' + f)
+    
+    rejected = [c for c in commands if c.error is not None]
+    if len(rejected) != 0:
+        print()
+        print('Cards rejected by Anki pre-flight check:')
+        for c in rejected:
+            print(' ! ' + c.notebook_filepath + ': ' + c.head)
+            print('     ' + c.error)
+        print('Aborted, nothing was done. Fix above cards and try again.')
+        return
 
     do_exec = input('Execute commands? [y/N]:')
     
     if do_exec == 'y':
         print('Executing...')
         mb.commands_execute(file_nb_dict, commands)
+        drop_outbox(outbox_filepath, notebook_filepaths)
+        if head is not None:
+            mb.write_last_synced(notes_folder_location, anki_deck_name, head)
     else:
         print('Aborted, nothing was done.')
+
+
+def sync_stream(notes_folder_location, anki_deck_name, debug=False, renderer=None,
+                validate=True, outbox_filepath=None):
+    
+    notebook_filepaths = mb.read_notebook_filepaths(notes_folder_location)
+    
+    print('Num notebooks to sync:', len(notebook_filepaths))
+    print('Streaming mode: commands are executed as each notebook is processed,')
+    print('there is no preview of commands before execution.')
+    
+    do_exec = input('Execute commands? [y/N]:')
+    
+    if do_exec != 'y':
+        print('Aborted, nothing was done.')
+        return
+    
+    print('Executing...')
+    try:
+        num_cards, num_synced, orphan_ids = mb.commands_stream(
+            notebook_filepaths, anki_deck_name, dbg_print=debug, renderer=renderer,
+            validate=validate)
+    except ValueError as e:
+        print(e)
+        print('Aborted, notebooks before it were synced. Fix above cards and try again.')
+        return
+    drop_outbox(outbox_filepath, notebook_filepaths)
+    
+    print()
+    print('Num orphaned cards in Anki:', len(orphan_ids))
+    print('Num cards in Jupyter:', num_cards)
+    print('Num cards synced:', num_synced)
+    print()
+    print('Orphaned cards:')
+    for id in orphan_ids:
+        front, back = mb.anki_get_note(id)
+        print(' * ' + front)
+
+
+def sync_fanout(notes_folder_location, anki_deck_name, endpoints, debug=False, renderer=None,
+                validate=True, workers=8, outbox_filepath=None):
+    
+    endpoints = [mb.parse_endpoint(ep) for ep in endpoints]
+    file_nb_dict = mb.read_notebooks(notes_folder_location)
+    
+    print('Rendering once, preparing for', len(endpoints), 'endpoints...')
+    plans = mb.commands_prepare_fanout(
+        file_nb_dict, anki_deck_name, endpoints, dbg_print=debug, renderer=renderer,
+        validate=validate, num_workers=workers)
+    
+    rejected = False
+    for ep in endpoints:
+        commands, orphan_ids = plans[ep.name]
+        print()
+        print('[' + ep.name + '] ' + ep.url + '  (meta key: ' + mb.endpoint_meta_key(ep.name) + ')')
+        print('Num orphaned cards in Anki:', len(orphan_ids))
+        print('Num cards in Jupyter:', len(commands))
+        print('Num cards require sync:', len(commands) - sum([c.cmd == 'noop' for c in commands]))
+        for c in commands:
+            if c.cmd != 'noop':
+                print(' * ' + c.cmd + ': ' + c.head)
+        for c in commands:
+            if c.error is not None:
+                print(' ! ' + c.notebook_filepath + ': ' + c.head)
+                print('     ' + c.error)
+                rejected = True
+    print()
+    
+    if rejected:
+        print('Aborted, nothing was done. Fix above cards and try again.')
+        return
+    
+    do_exec = input('Execute commands on all endpoints? [y/N]:')
+    
+    if do_exec == 'y':
+        print('Executing...')
+        mb.commands_execute_fanout(file_nb_dict, endpoints, plans)
+        if 'default' in [ep.name for ep in endpoints]:
+            drop_outbox(outbox_filepath, list(file_nb_dict))
+    else:
+        print('Aborted, nothing was done.')
+
+
+def drop_outbox(outbox_filepath, notebook_filepaths):
+    # Outbox holds older content of just synced cards, must not be flushed
+    if outbox_filepath is None:
+        return
+    num_dropped = mb.outbox_drop(outbox_filepath, notebook_filepaths)
+    if num_dropped != 0:
+        print('Num cards dropped from outbox, synced online:', num_dropped)
+
+
+def sync_queue(notes_folder_location, anki_deck_name, outbox_filepath, debug=False,
+               renderer=None):
+    
+    file_nb_dict = mb.read_notebooks(notes_folder_location)
+    
+    print('Queueing, Anki is not contacted...')
+    num_cards, num_queued = mb.outbox_queue(outbox_filepath, file_nb_dict, anki_deck_name,
+                                            dbg_print=debug, renderer=renderer)
+    
+    print('Num cards in Jupyter:', num_cards)
+    print('Num cards queued:', num_queued)
+    print('Num cards waiting in outbox:', len(mb.outbox_pending(outbox_filepath)))
+    print('Outbox:', outbox_filepath)
+    print('Run flush when Anki is available.')
+
+
+def flush(outbox_filepath):
+    
+    pending = mb.outbox_pending(outbox_filepath)
+    print('Num cards waiting in outbox:', len(pending))
+    for note_id, front in pending:
+        print(' * ' + ('new' if note_id is None else note_id) + ': ' + front)
+    
+    if len(pending) == 0:
+        return
+    
+    do_exec = input('Flush outbox to Anki? [y/N]:')
+    
+    if do_exec != 'y':
+        print('Aborted, nothing was done.')
+        return
+    
+    print('Executing...')
+    commands = mb.outbox_flush(outbox_filepath)
+    
+    failed = [c for c in commands if c.error is not None]
+    sent = [c for c in commands if c.cmd in {'add', 'add2', 'update'} and c.error is None]
+    print('Num cards sent:', len(sent))
+    print('Num cards up to date:', sum([c.cmd == 'noop' and c.error is None for c in commands]))
+    if len(failed) != 0:
+        print('Cards not sent:')
+        for c in failed:
+            print(' ! ' + c.notebook_filepath + ': ' + c.head)
+            print('     ' + c.error)
+
+
+def export(notes_folder_location, anki_deck_name, apkg_filepath, model_id, debug=False,
+           renderer=None):
+    
+    file_nb_dict = mb.read_notebooks(notes_folder_location)
+    
+    print('Exporting...')
+    commands = mb.export_apkg(file_nb_dict, anki_deck_name, apkg_filepath, model_id,
+                              dbg_print=debug, renderer=renderer)
+    
+    print('Num cards exported:', len(commands))
+    print('Num new note IDs written to notebooks:', sum([c.notebook_changed for c in commands]))
+    print('Written:', apkg_filepath)
+    print('Import it in Anki with File | Import, then use sync as usual.')
+
     
 def main():
         
     parser = argparse.ArgumentParser(description='Jupyter <-> Anki sync tool.')
-    parser.add_argument('command', choices=['sync', 'prune'], 
+    parser.add_argument('command', choices=['sync', 'flush', 'export', 'prune'], 
                         help='Command to run.')
     parser.add_argument('path', nargs='?',
                         help='Path to folder with .ipynb files, or single file')
     parser.add_argument('deck', nargs='?',
                         help='Name of existing Anki deck to sync with')
+    parser.add_argument('output', nargs='?',
+                        help='Output .apkg file, export command only')
+    parser.add_argument('--model-id', type=int, metavar='ID',
+                        help='Basic-MathJax model ID in target collection, export command only, '
+                             'default is to ask AnkiConnect')
     parser.add_argument('--debug', action='store_true',
                         help='Print debug info')
+    parser.add_argument('--renderer', choices=['mistune', 'nbconvert'], default=None,
+                        help='Markdown renderer backend, default is fast mistune')
+    parser.add_argument('--no-validate', action='store_true',
+                        help='Skip pre-flight canAddNotes check of new cards')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Number of parallel Anki lookups during sync')
+    parser.add_argument('--since', metavar='REV',
+                        help='Only sync notebooks changed in git since REV, '
+                             'default is last synced commit')
+    parser.add_argument('--full', action='store_true',
+                        help='Sync all notebooks, ignore git changes')
+    parser.add_argument('--endpoint', action='append', metavar='NAME=URL',
+                        help='Sync to multiple AnkiConnect endpoints concurrently, '
+                             'repeat for each endpoint, e.g. --endpoint default=http://localhost:8765')
+    parser.add_argument('--queue', action='store_true',
+                        help='Do not contact Anki, store cards in outbox for later flush')
+    parser.add_argument('--outbox', metavar='PATH',
+                        help='Outbox SQLite file, default is inside notes repo .git folder')
+    parser.add_argument('--stream', action='store_true',
+                        help='Sync one notebook at a time, no preview, bounded memory')
     args = parser.parse_args()
     
     print(args.debug)
@@ -65,7 +289,50 @@ def main():
             parser.error('Specified path must exist.')
         if args.deck is None:
             parser.error('Please specify Anki deck.')
-        sync(args.path, args.deck, args.debug)
+        if args.since is not None and mb.git_is_repo(args.path) \
+                and not mb.git_is_commit(args.path, args.since):
+            parser.error('--since ' + args.since + ' is not a commit in notes repo.')
+        outbox = args.outbox or mb.outbox_default_filepath(args.path)
+        if args.queue:
+            sync_queue(args.path, args.deck, outbox, args.debug, args.renderer)
+        elif args.endpoint:
+            sync_fanout(args.path, args.deck, args.endpoint, args.debug, args.renderer,
+                        not args.no_validate, args.workers, outbox)
+        elif args.stream:
+            sync_stream(args.path, args.deck, args.debug, args.renderer, not args.no_validate,
+                        outbox)
+        else:
+            try:
+                sync(args.path, args.deck, args.debug, args.renderer, not args.no_validate,
+                     args.workers, args.since, args.full, outbox)
+            except urllib.error.URLError as e:
+                print('Could not connect to AnkiConnect:', e.reason)
+                print('Use sync --queue to store cards in outbox and flush them later.')
+                sys.exit(1)
+    
+    if args.command == 'flush':
+        if args.outbox is None and args.path is None:
+            parser.error('Please specify path or --outbox.')
+        outbox = args.outbox or mb.outbox_default_filepath(args.path)
+        flush(outbox)
+    
+    if args.command == 'export':
+        if args.path is None:
+            parser.error('Please specify path.')
+        if not os.path.exists(args.path):
+            parser.error('Specified path must exist.')
+        if args.deck is None:
+            parser.error('Please specify Anki deck.')
+        if args.output is None or not args.output.endswith('.apkg'):
+            parser.error('Please specify output .apkg file.')
+        model_id = args.model_id
+        if model_id is None:
+            try:
+                model_id = mb.anki_model_id('Basic-MathJax')
+            except urllib.error.URLError as e:
+                parser.error('Could not connect to AnkiConnect (' + str(e.reason) + '), '
+                             'please specify --model-id of Basic-MathJax model in target collection.')
+        export(args.path, args.deck, args.output, model_id, args.debug, args.renderer)
         
 
 